@@ -0,0 +1,72 @@
+'''
+Compares write and read throughput of series over clusters built with
+different connection settings. Needs a running Cassandra node:
+
+    python benchmarks/cluster_settings.py --hosts 127.0.0.1 --inserts 5000
+'''
+
+import argparse
+import time
+
+from cassandra.cluster import Cluster
+
+from kairos_cassandra_driver import Timeseries
+from kairos_cassandra_driver.utils import (create_cluster, create_keyspace,
+                                           drop_keyspace)
+
+KEYSPACE = 'kcd_benchmark'
+
+SETTINGS = [
+    ('plain Cluster', None),
+    ('tuned', {}),
+    ('tuned, no compression', {'compression': False}),
+    ('tuned, 8 executor threads', {'executor_threads': 8}),
+    ('tuned, protocol v2, 4 connections', {'protocol_version': 2,
+                                           'connections_per_host': 4}),
+]
+
+
+def run(cluster, inserts):
+    series = Timeseries(cluster, type='count', keyspace=KEYSPACE,
+                        intervals={'minute': {'step': 60}})
+    series._hold_session()
+    try:
+        start = time.time()
+        for i in range(inserts):
+            series.insert('bench', timestamp=1800000000 + i)
+        written = time.time()
+        for i in range(0, inserts, 60):
+            series.series('bench', 'minute', end=1800000000 + i, steps=10)
+        read = time.time()
+    finally:
+        series._release_session()
+    return inserts / (written - start), (inserts // 60) / (read - written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--hosts', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9042)
+    parser.add_argument('--inserts', type=int, default=5000)
+    args = parser.parse_args()
+    hosts = args.hosts.split(',')
+
+    for label, settings in SETTINGS:
+        if settings is None:
+            cluster = Cluster(hosts, port=args.port)
+        else:
+            cluster = create_cluster(hosts, port=args.port, **settings)
+        try:
+            create_keyspace(cluster, KEYSPACE, replication_factor=1)
+            writes, reads = run(cluster, args.inserts)
+            print('%-36s %8.0f inserts/s %8.0f series/s' %
+                  (label, writes, reads))
+        except Exception as e:
+            print('%-36s failed: %r' % (label, e))
+        finally:
+            drop_keyspace(cluster, KEYSPACE)
+            cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+Measures the startup cost of short-lived processes using the package:
+import time of the package and its tools, and construction of a series,
+each in fresh interpreters. Construction doesn't connect, so no
+Cassandra node is needed:
+
+    python benchmarks/startup.py --runs 10
+
+Exits with an error if importing the package alone imports kairos or the
+cassandra driver.
+'''
+
+import argparse
+import json
+import subprocess
+import sys
+
+CASES = [
+    ('import package', '', 'import kairos_cassandra_driver'),
+    ('import loader', '', 'import kairos_cassandra_driver.loader'),
+    ('import export', '', 'import kairos_cassandra_driver.export'),
+    ('import Timeseries', '',
+     'from kairos_cassandra_driver import Timeseries'),
+    ('construct series', 'from kairos_cassandra_driver import Timeseries',
+     "Timeseries(['127.0.0.1'], type='count', "
+     "intervals={'minute': {'step': 60}})"),
+]
+
+TIMER = '''
+import json, sys, time
+%s
+start = time.time()
+%s
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed, 'modules': len(sys.modules),
+                  'kairos': 'kairos' in sys.modules,
+                  'cassandra': 'cassandra' in sys.modules}))
+'''
+
+
+def measure(setup, stmt, runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', TIMER % (setup, stmt)])
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    results.sort(key=lambda r: r['elapsed'])
+    return results[0], results[len(results) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    eager = []
+    print('%-20s %9s %9s %8s  %s' % ('', 'min ms', 'median ms', 'modules',
+                                     'imports'))
+    for label, setup, stmt in CASES:
+        best, median = measure(setup, stmt, args.runs)
+        heavy = [m for m in ('kairos', 'cassandra') if best[m]]
+        print('%-20s %9.1f %9.1f %8d  %s' % (
+            label, best['elapsed'] * 1000, median['elapsed'] * 1000,
+            best['modules'], ', '.join(heavy) or '-'))
+        if label == 'import package':
+            eager = heavy
+    if eager:
+        sys.exit('Importing the package imports %s' % ', '.join(eager))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,56 @@
 from __future__ import absolute_import
 
-from .cassandra_timeseries import Timeseries, CassandraSeries
+import sys
+from types import ModuleType
+
+from .registry import register
+
+# Objects exported by the package, imported from their module on first
+# access so that importing the package, or one of the tools that don't
+# need them, doesn't import kairos and the cassandra driver
+_all_by_module = {
+    'kairos_cassandra_driver.cassandra_timeseries': ['Timeseries',
+                                                     'CassandraSeries'],
+    'kairos_cassandra_driver.recorder': ['Recorder'],
+    'kairos_cassandra_driver.sharding': ['ShardedTimeseries'],
+}
+
+_object_origins = {}
+for _module, _names in _all_by_module.items():
+    for _name in _names:
+        _object_origins[_name] = _module
+
+
+# Only if kairos is imported already, the backend module registers the
+# backend otherwise
+register()
+
+
+class _LazyModule(ModuleType):
+    """Package module that imports its exported objects when first used"""
+
+    def __getattr__(self, name):
+        if name in _object_origins:
+            module = __import__(_object_origins[name], None, None, [name])
+            for extra in _all_by_module[module.__name__]:
+                setattr(self, extra, getattr(module, extra))
+        return ModuleType.__getattribute__(self, name)
+
+    def __dir__(self):
+        return sorted(set(list(self.__all__) + [
+            '__all__', '__doc__', '__file__', '__name__', '__package__',
+            '__path__']))
+
+
+_old_module = sys.modules[__name__]
+_new_module = sys.modules[__name__] = _LazyModule(__name__)
+_new_module.__dict__.update({
+    '__file__': __file__,
+    '__package__': __name__,
+    '__path__': __path__,
+    '__doc__': __doc__,
+    '__all__': tuple(_object_origins),
+    # Python 2 clears the globals of a collected module, which the
+    # methods above still use
+    '_old_module': _old_module,
+})
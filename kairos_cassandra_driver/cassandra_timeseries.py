@@ -7,15 +7,57 @@ https://github.com/agoragames/kairos/blob/master/LICENSE.txt
 import kairos
 from kairos.timeseries import (BACKENDS, Series, Histogram,
                                Gauge, Set, Count,)
+from kairos.exceptions import UnknownInterval
 from kairos.cassandra_backend import TYPE_MAP, QUOTE_TYPES, QUOTE_MATCH
 
-from cassandra import ConsistencyLevel
-from cassandra.query import SimpleStatement
-
-from collections import OrderedDict
-
-from .utils import create_table
-from .helpers import calculate_irtime
+from cassandra import (ConsistencyLevel, OperationTimedOut,
+                       Unavailable, WriteTimeout)
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, NoHostAvailable
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
+
+from collections import Counter, OrderedDict
+import binascii
+import fnmatch
+import re
+import time
+import uuid
+
+from .cursor import SeriesCursor
+from .utils import (create_cluster, create_table, string_types,
+                    timeseries_table_options)
+from .leaderboard import Leaderboard
+from .registry import ContactPoints, register
+from .helpers import (histogram_percentile, series_buckets, BucketCalculator,
+                      LRUCache, LRUSet)
+from .sketches import BloomFilter, HyperLogLog, LogBins
+from .spool import Spool, SpoolReplayer
+from .tracing import HotNames, QuerySampler
+
+PERCENTILE_MATCH = re.compile(r'^p(\d+(\.\d+)?)$')
+
+# Rows of a bucket buffered by aggregate before they are joined
+AGGREGATE_BUFFER = 32
+
+# Write errors after which a mutation is spooled instead of lost
+SPOOL_ERRORS = (NoHostAvailable, OperationTimedOut, Unavailable, WriteTimeout)
+# Those of them proving the mutation wasn't applied, the only ones
+# mutations that can't be applied twice are spooled after
+UNAPPLIED_ERRORS = (NoHostAvailable, Unavailable)
+
+# Clients taken as contact points, and the arguments of the cluster
+# built from them
+CONTACT_POINTS = (list, tuple) + (string_types,)
+CLUSTER_KWARGS = ('port', 'local_dc', 'protocol_version', 'compression',
+                  'connections_per_host', 'request_timeout',
+                  'connect_timeout', 'executor_threads')
+
+# Side table of the leaderboards of all the series of a keyspace
+LEADERBOARD_TABLE = 'leaderboard'
+LEADERBOARD_COLUMNS = {'table_name': 'text', 'interval': 'text',
+                       'i_time': 'bigint', 'writer': 'text', 'name': 'text',
+                       'count': 'bigint', 'error': 'bigint'}
+LEADERBOARD_KEY = ['(table_name, interval, i_time)', 'writer', 'name']
 
 
 class Timeseries(kairos.Timeseries):
@@ -23,13 +65,20 @@ class Timeseries(kairos.Timeseries):
         Also acts as a factory to return the correct subclass
         if 'type=' keyword argument supplied.
         Uses cassandra-driver for 'cassandra' backend
-        ('client' should be a cassandra.cluster.Cluster instance."""
+        ('client' should be a cassandra.cluster.Cluster instance,
+        or contact points to build one with utils.create_cluster
+        from the CLUSTER_KWARGS keyword arguments)."""
 
     def __new__(cls, client, **kwargs):
-        client_module = client.__module__.split('.')[0]
+        if isinstance(client, CONTACT_POINTS):
+            client_module = 'cassandra'
+        else:
+            client_module = client.__module__.split('.')[0]
         backend = BACKENDS.get(client_module)
         if backend:
-            return backend(client, **kwargs)
+            # Not initialized here: __init__ runs once on the instance
+            # returned, with the same arguments
+            return backend.__new__(backend, client, **kwargs)
 
         raise ImportError(
             "Unsupported or unknown client type %s", client_module)
@@ -39,6 +88,25 @@ class CassandraBackend(Timeseries):
 
     cluster = None
     session = None
+    # Nesting depth of operations sharing the session, see _hold_session
+    _session_holds = 0
+    # Whether applying an insert statement twice gives the same result
+    _idempotent_insert = False
+    # Whether the table has counter columns
+    _counter = False
+    # Whether an insert overwrites the value of its bucket
+    _overwrite = False
+    # Whether the rows can be exported, and the value type of the exported
+    # values when it isn't that of the series, see export
+    _exportable = True
+    _export_value_type = None
+    # kairos type and value columns of the table
+    _type_name = None
+    _value_columns = None
+    # Primary key of the table, name being the partition key
+    _primary_key = ['name', 'interval', 'i_time', 'r_time']
+    # Write statements collected instead of executed, see Recorder
+    _pending = None
     default_columns = {
         'name': 'text',
         'interval': 'text',
@@ -46,6 +114,8 @@ class CassandraBackend(Timeseries):
         'r_time': 'bigint'}
 
     def __new__(cls, *args, **kwargs):
+        if cls is not CassandraBackend:
+            return kairos.Timeseries.__new__(cls, *args, **kwargs)
         ttypes_map = {
             'series': CassandraSeries,
             'histogram': CassandraHistogram,
@@ -53,40 +123,203 @@ class CassandraBackend(Timeseries):
             'gauge': CassandraGauge,
             'set': CassandraSet,
         }
+        sketches_map = {
+            'histogram': CassandraHistogramSketch,
+            'set': CassandraSetSketch,
+        }
         ttype = kwargs.pop('type', None)
-        type_cls = ttypes_map.get(ttype)
+        if kwargs.get('sketch'):
+            type_cls = sketches_map.get(ttype)
+        else:
+            type_cls = ttypes_map.get(ttype)
         if type_cls:
             return type_cls.__new__(type_cls, *args, **kwargs)
         raise NotImplementedError("No implementation for %s type" % ttype)
 
+    @classmethod
+    def url_parse(cls, url, **kwargs):
+        '''Contact points of a comma separated string of hosts, called by
+           kairos for string clients. URLs are left to other backends.'''
+        if '://' not in url:
+            return ContactPoints(url.split(','))
+
     def __init__(self, client, **kwargs):
+        self._own_cluster = isinstance(client, CONTACT_POINTS)
+        if self._own_cluster:
+            client = create_cluster(client, **dict(
+                (k, kwargs[k]) for k in CLUSTER_KWARGS if k in kwargs))
         value_type = kwargs.get('value_type', float)
         self._value_type = TYPE_MAP[value_type]
         self._table = kwargs.get('table_name', self._table)
+        self.default_columns = dict(CassandraBackend.default_columns)
         self.cluster = client
         self._keyspace = kwargs.get('keyspace', 'kairos')
         self._create_table = kwargs.get('create_table', True)
+        self._table_options = kwargs.get('table_options', {})
+        self._time_window_compaction = kwargs.get(
+            'time_window_compaction', False)
         self.write_consistency_level = kwargs.get(
             'write_consistency_level', ConsistencyLevel.ONE)
         self.read_consistency_level = kwargs.get(
             'read_consistency_level', ConsistencyLevel.ONE)
+        self._retry_policy = kwargs.get('retry_policy')
+        trace_sample_rate = kwargs.get('trace_sample_rate', 0)
+        self._sampler = (QuerySampler(trace_sample_rate,
+                                      kwargs.get('trace_history', 100))
+                         if trace_sample_rate else None)
+        hot_names_size = kwargs.get('hot_names_size', 0)
+        self._hot_names = HotNames(hot_names_size) if hot_names_size else None
+        self._writer_id = kwargs.get('writer_id') or uuid.uuid4().hex
+        leaderboard_size = kwargs.get('leaderboard_size', 0)
+        self._leaderboard = (
+            Leaderboard(leaderboard_size,
+                        kwargs.get('leaderboard_flush_interval', 10))
+            if leaderboard_size else None)
+        self._speculative_execution_policy = kwargs.get(
+            'speculative_execution_policy')
+        # Name of the execution profile of that policy, see _get_session
+        self._speculative_profile = None
+        self.stats = Counter()
+        spool = kwargs.get('spool')
+        if spool is not None and not isinstance(spool, Spool):
+            spool = Spool(spool)
+        self._spool = spool
+        self._spool_mode = kwargs.get('spool_mode', 'fallback')
+        self._spooling = False
         super(CassandraBackend, self).__init__(client, **kwargs)
+        for config in self._intervals.values():
+            config['bucket_calc'] = BucketCalculator(config)
+
+    def _get_table_options(self):
+        '''Options the table is created with: explicit 'table_options'
+           over the ones derived from the intervals when
+           'time_window_compaction' is set.'''
+        options = {}
+        if self._time_window_compaction:
+            options.update(timeseries_table_options(self._intervals,
+                                                    counters=self._counter))
+        options.update(self._table_options)
+        return options
+
+    def _setup_table(self):
+        '''Creates the table, once, unless 'create_table' is False'''
+        if self._create_table:
+            create_table(self.cluster, self._keyspace, self._table,
+                         self.default_columns, self._primary_key,
+                         options=self._get_table_options())
+            if self._leaderboard is not None:
+                create_table(self.cluster, self._keyspace, LEADERBOARD_TABLE,
+                             LEADERBOARD_COLUMNS, LEADERBOARD_KEY)
+            self._create_table = False
 
     def _get_session(self):
+        '''Session on the keyspace. Nothing is sent to the cluster until
+           the first one is opened, after setting up the table.'''
         if self.session is not None:
             return self.session
+        self._setup_table()
         self.session = self.cluster.connect(self._keyspace)
+        if (self._speculative_execution_policy and
+                self._speculative_profile is None):
+            self._speculative_profile = self._add_speculative_profile()
         return self.session
 
+    def _add_speculative_profile(self):
+        '''Registers the default execution profile with the speculative
+           execution policy, unless a profile of the cluster already has
+           that policy. Returns the name of the profile.'''
+        policy = self._speculative_execution_policy
+        for name, profile in list(
+                self.cluster.profile_manager.profiles.items()):
+            if profile.speculative_execution_policy is policy:
+                return name
+        name = 'speculative_%s' % uuid.uuid4().hex
+        self.cluster.add_execution_profile(
+            name, self.session.execution_profile_clone_update(
+                EXEC_PROFILE_DEFAULT, speculative_execution_policy=policy))
+        return name
+
+    def _statement(self, query, idempotent, consistency_level, **kwargs):
+        '''Statement for a query. Only idempotent statements get the
+           configured retry policy, and are run speculatively by _execute.'''
+        return SimpleStatement(
+            query, consistency_level=consistency_level,
+            is_idempotent=idempotent,
+            retry_policy=self._retry_policy if idempotent else None,
+            **kwargs)
+
+    def _read_statement(self, query, **kwargs):
+        return self._statement(query, True, self.read_consistency_level,
+                               **kwargs)
+
+    def _execute(self, stmt, parameters=None, name=None):
+        '''Executes a statement, with the speculative execution policy if
+           one is configured and the statement is idempotent. That policy
+           requires a cluster configured with execution profiles.
+           Statements on a series name are sampled for tracing and
+           counted in the hot names sketches when those are enabled.'''
+        session = self._get_session()
+        kwargs = {}
+        if stmt.is_idempotent and self._speculative_profile:
+            kwargs['execution_profile'] = self._speculative_profile
+        trace = self._sampler is not None and self._sampler.sample()
+        if trace:
+            kwargs['trace'] = True
+        result = session.execute(stmt, parameters, **kwargs)
+        if trace:
+            self._sampler.add(stmt, name, result.response_future)
+        if self._hot_names is not None and name is not None:
+            result = self._hot_names.counted(self._table, name, result)
+        return result
+
+    def traces(self, max_wait=2.0):
+        '''Sampled query traces, see QuerySampler.traces'''
+        if self._sampler is None:
+            return []
+        return self._sampler.traces(max_wait)
+
+    def hot_names(self, n=10, by='requests'):
+        '''Series with the most requests or rows read, see HotNames.top'''
+        if self._hot_names is None:
+            return []
+        return self._hot_names.top(n, by)
+
+    def _hold_session(self):
+        '''Keeps the session open across several operations until the
+           matching _release_session call.'''
+        self._session_holds += 1
+        return self._get_session()
+
+    def _release_session(self):
+        self._session_holds -= 1
+        self._shutdown_session()
+
     def _shutdown_session(self):
-        if self.session:
+        if self.session and not self._session_holds:
             self.session.shutdown()
             self.session = None
 
-    def _insert(self, name, value, timestamp, intervals, **kwargs):
+    def close(self):
+        '''Flushes the leaderboard and shuts down the session, and the
+           cluster if the series built it from contact points.'''
+        self.flush_leaderboard()
+        self._session_holds = 0
+        self._shutdown_session()
+        if self._own_cluster:
+            self.cluster.shutdown()
+
+    def _quote(self, value):
         if self._value_type in QUOTE_TYPES and not QUOTE_MATCH.match(value):
             value = "'%s'" % (value)
+        return value
+
+    def _insert(self, name, value, timestamp, intervals, **kwargs):
+        value = self._quote(value)
         for interval, config in self._intervals.items():
+            if not intervals:
+                self._insert_data(
+                    name, value, timestamp, interval, config, **kwargs)
+                continue
             timestamps = self._normalize_timestamps(
                 timestamp, intervals, config)
             for tstamp in timestamps:
@@ -94,15 +327,230 @@ class CassandraBackend(Timeseries):
                     name, value, tstamp, interval, config, **kwargs)
         self._shutdown_session()
 
-    def _insert_data(self, name, value, timestamp, interval, config):
+    def _batch_insert(self, inserts, intervals, **kwargs):
+        '''Inserts in timestamp order over one session, with the buckets
+           of all the timestamps computed up front.'''
+        timestamps = sorted(inserts)
+        calcs = [config['bucket_calc'] for config in self._intervals.values()]
+        for calc in calcs:
+            calc.prime(timestamps)
+        self._hold_session()
+        try:
+            for timestamp in timestamps:
+                for name, values in inserts[timestamp].items():
+                    for value in values:
+                        self._insert(name, value, timestamp, intervals,
+                                     **kwargs)
+        finally:
+            for calc in calcs:
+                calc.clear()
+            self._release_session()
+
+    def _insert_data(self, name, value, timestamp, interval, config,
+                     applied=None):
         stmt = self._insert_stmt(name, value, timestamp, interval, config)
         if stmt:
-            stmt = SimpleStatement(stmt, consistency_level=self.write_consistency_level)
-            self._get_session().execute(stmt)
+            self._write(stmt, name, applied)
+            if self._leaderboard is not None:
+                self._count_leader(name, value, timestamp, interval, config)
+
+    def _count_leader(self, name, value, timestamp, interval, config):
+        '''Counts a write in the leaderboard, by its value for counts and
+           as one otherwise, and flushes it when due. Flush errors with
+           the cluster unavailable don't fail the insert.'''
+        i_time, _, ttl = config['bucket_calc'].buckets(timestamp)
+        count = value if self._type_name == 'count' else 1
+        self._leaderboard.add(interval, i_time, ttl, name, count)
+        if self._leaderboard.due():
+            try:
+                self.flush_leaderboard()
+            except SPOOL_ERRORS:
+                self.stats['leaderboard_errors'] += 1
+
+    def flush_leaderboard(self):
+        '''Writes the leaderboard rows of this writer that changed, with
+           one batch per bucket as a bucket is one partition.'''
+        if self._leaderboard is None:
+            return
+        changes = self._leaderboard.changes()
+        for interval, i_time, ttl, rows, evicted, applied in changes:
+            batch = BatchStatement(
+                batch_type=BatchType.UNLOGGED,
+                consistency_level=self.write_consistency_level,
+                retry_policy=self._retry_policy)
+            batch.is_idempotent = True
+            for name, count, error in rows:
+                stmt = """INSERT INTO %s
+                          (table_name, interval, i_time, writer, name,
+                           count, error)
+                          VALUES ('%s', '%s', %s, '%s', '%s', %s, %s)
+                       """ % (LEADERBOARD_TABLE, self._table, interval, i_time,
+                              self._writer_id, name, count, error)
+                if ttl:
+                    stmt += ' USING TTL %s' % ttl
+                batch.add(stmt)
+            for name in evicted:
+                batch.add("""DELETE FROM %s
+                             WHERE table_name = '%s' AND interval = '%s'
+                             AND i_time = %s AND writer = '%s' AND name = '%s'
+                          """ % (LEADERBOARD_TABLE, self._table, interval,
+                                 i_time, self._writer_id, name))
+            self._execute(batch)
+            applied()
+        self._shutdown_session()
+
+    def top(self, interval, timestamp=None, n=10):
+        """Heaviest names of a bucket, with one partition read
+           :param interval: interval of the bucket
+           :param timestamp: timestamp in the bucket, now by default
+           Needs ``leaderboard_size``. Returns [(name, count, error)] of
+           up to n names, counting writes, or the values inserted for
+           counts, summed over the writers. Counts are upper bounds, over
+           by at most error, and include the writers' last flush only.
+        """
+        if self._leaderboard is None:
+            raise ValueError('Leaderboards need leaderboard_size')
+        config = self._intervals.get(interval)
+        if not config:
+            raise UnknownInterval(interval)
+        self.flush_leaderboard()
+        i_time = config['i_calc'].to_bucket(timestamp or time.time())
+        stmt = self._read_statement(
+            """SELECT name, count, error FROM %s
+               WHERE table_name = '%s' AND interval = '%s' AND i_time = %s
+            """ % (LEADERBOARD_TABLE, self._table, interval, i_time))
+        totals = {}
+        for row in self._execute(stmt):
+            total = totals.setdefault(row.name, [0, 0])
+            total[0] += row.count
+            total[1] += row.error
+        self._shutdown_session()
+        leaders = sorted(totals.items(), key=lambda item: -item[1][0])
+        return [(name, count, error) for name, (count, error) in leaders[:n]]
+
+    def _insert_stmts(self, name, value, timestamp, intervals=0):
+        '''Yields the ((interval, i_time, r_time), stmt) inserting a value
+           in every interval, bypassing the write filters of _insert_data.'''
+        value = self._quote(value)
+        for interval, config in self._intervals.items():
+            timestamps = self._normalize_timestamps(
+                timestamp, intervals, config)
+            for tstamp in timestamps:
+                stmt = self._insert_stmt(
+                    name, value, tstamp, interval, config)
+                if stmt:
+                    cell = config['bucket_calc'].buckets(tstamp)[:2]
+                    yield (interval,) + cell, stmt
+
+    def _write(self, stmt, name=None, applied=None):
+        '''Executes a write statement, then calls applied() to update the
+           write filters. With a spool, writes go to it when the cluster
+           is unavailable and until replay_spool drains it, or always in
+           'always' spool_mode, and count as applied once spooled. While _pending is a list, (stmt, applied)
+           pairs are collected in it instead, see Recorder.'''
+        if self._spool is not None:
+            if self._spooling or self._spool_mode == 'always':
+                return self._spool_write(stmt, name, applied)
+        if self._pending is not None:
+            return self._pending.append((stmt, applied))
+
+        query = self._statement(stmt, self._idempotent_insert,
+                                self.write_consistency_level)
+        try:
+            self._execute(query, name=name)
+        except SPOOL_ERRORS as e:
+            if not self._spoolable(e):
+                raise
+            # Keep spooling so that replay preserves the order of writes
+            self._spooling = True
+            self._spool_write(stmt, name, applied)
+        else:
+            if applied:
+                applied()
+
+    def _spoolable(self, error):
+        '''Whether a write that failed with error is spooled. Counter
+           updates and list appends may have been applied on a timeout,
+           and replaying them would apply them twice.'''
+        return self._spool is not None and (
+            self._idempotent_insert or isinstance(error, UNAPPLIED_ERRORS))
+
+    def _spool_write(self, stmt, name=None, applied=None):
+        '''Appends a write to the spool. The spool is replayed in order,
+           so the write filters learn of it as of an applied write.'''
+        self._spool.append(stmt, self.write_consistency_level,
+                           self._idempotent_insert, name)
+        self.stats['spooled_writes'] += 1
+        if applied:
+            applied()
+
+    def replay_spool(self, **kwargs):
+        '''Replays the spooled writes, returns the number replayed.
+           Keyword arguments are passed to SpoolReplayer.'''
+        kwargs.setdefault('retry_policy', self._retry_policy)
+        replayer = SpoolReplayer(self._spool, self._get_session(), **kwargs)
+        try:
+            replayed = replayer.replay()
+        finally:
+            self._shutdown_session()
+        if replayer.last_error is None:
+            self._spooling = False
+        self.stats['replayed_writes'] += replayed
+        return replayed
+
+    def spool_lag(self):
+        '''Lag of the spool, see Spool.lag'''
+        return self._spool.lag()
 
     def _insert_stmt(self, name, value, timestamp, interval, config):
         raise NotImplementedError
 
+    def _type_get_stmt(self, name, interval, i_bucket, i_end=None):
+        '''Statement reading a bucket, or the buckets up to i_end'''
+        stmt = """SELECT i_time, r_time, %s
+                  FROM %s
+                  WHERE name = '%s' AND interval = '%s'
+               """ % (self._value_columns, self._table, name, interval)
+        if i_end:
+            stmt += ' AND i_time >= %s AND i_time <= %s' % (i_bucket, i_end)
+        else:
+            stmt += ' AND i_time = %s' % (i_bucket)
+        stmt += ' ORDER BY interval, i_time, r_time'
+        return self._read_statement(stmt)
+
+    def _type_rows(self, rows):
+        '''{i_time: {r_time: data}} of the rows read by _type_get_stmt'''
+        raise NotImplementedError
+
+    def _type_get(self, name, interval, i_bucket, i_end=None):
+        stmt = self._type_get_stmt(name, interval, i_bucket, i_end)
+        rval = self._type_rows(self._execute(stmt, name=name))
+        self._shutdown_session()
+        return rval
+
+    def _copy_stmts(self, name, interval, data):
+        '''Yields the statements writing the rows of a name read by
+           _type_get to an empty partition, skipping expired buckets.'''
+        config = self._intervals[interval]
+        for i_time, i_data in data.items():
+            ttl = config['bucket_calc'].buckets(
+                config['i_calc'].from_bucket(i_time))[2]
+            if config['expire'] and not ttl:
+                continue
+            for r_time, row in i_data.items():
+                r_time = -1 if r_time is None else r_time
+                for stmt in self._copy_row_stmts(name, interval, i_time,
+                                                 r_time, ttl, row):
+                    yield stmt
+
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        raise NotImplementedError
+
+    def _table_spec(self, ttl):
+        if ttl:
+            return "%s USING TTL %s " % (self._table, ttl)
+        return self._table
+
     def _get(self, name, interval, config, timestamp, **kwargs):
         i_bucket = config['i_calc'].to_bucket(timestamp)
         fetch = kwargs.get('fetch')
@@ -161,51 +609,229 @@ class CassandraBackend(Timeseries):
         self._shutdown_session()
         return rval
 
+    def series_multi(self, name, intervals, **kwargs):
+        '''Runs series() for each of intervals with the same arguments,
+           reading the buckets of every interval concurrently over one
+           session. Returns {interval: series}.'''
+        if not isinstance(name, (list, tuple, set)):
+            names = [name]
+        else:
+            names = list(name)
+        keys, statements = [], []
+        for interval in intervals:
+            config = self._intervals.get(interval)
+            if not config:
+                raise UnknownInterval(interval)
+            buckets = series_buckets(config, kwargs.get('start'),
+                                     kwargs.get('end'), kwargs.get('steps'))
+            for n in names:
+                keys.append((n, interval))
+                statements.append((self._type_get_stmt(
+                    n, interval, buckets[0], buckets[-1]), ()))
+
+        session = self._hold_session()
+        try:
+            results = execute_concurrent(session, statements,
+                                         raise_on_first_error=True)
+            data = dict((key, self._type_rows(rows))
+                        for key, (_, rows) in zip(keys, results))
+
+            def fetch(session, table, name, interval, buckets):
+                return data[(name, interval)]
+
+            rval = {}
+            for interval in intervals:
+                rval[interval] = self.series(name, interval, fetch=fetch,
+                                             **kwargs)
+        finally:
+            self._release_session()
+        return rval
+
+    def _aggregate_rows(self, session, names, interval, buckets,
+                        concurrency, join_rows):
+        '''Reads the buckets of several names concurrently and joins
+           their rows cell by cell as the reads complete, buffering at
+           most AGGREGATE_BUFFER rows per cell.'''
+        statements = ((self._type_get_stmt(name, interval, buckets[0],
+                                           buckets[-1]), ())
+                      for name in names)
+        results = execute_concurrent(session, statements,
+                                     concurrency=concurrency,
+                                     raise_on_first_error=True,
+                                     results_generator=True)
+        cells = {}
+        for _, rows in results:
+            for i_bucket, i_data in self._type_rows(rows).items():
+                for r_bucket, row in i_data.items():
+                    cell = cells.setdefault((i_bucket, r_bucket), [])
+                    cell.append(row)
+                    if len(cell) >= AGGREGATE_BUFFER:
+                        cell[:] = [join_rows(cell)]
+
+        rval = OrderedDict()
+        for key in sorted(cells):
+            rval.setdefault(key[0], OrderedDict())[key[1]] = join_rows(
+                cells[key])
+        return rval
+
+    def _join_names(self, rows):
+        '''Joins the rows of a bucket of several names, see aggregate'''
+        return self._join(rows)
+
+    def aggregate(self, names, interval, concurrency=16, **kwargs):
+        """Series of several names merged into one, in the form returned
+           by series() for a single name
+           :param names: list of names, or a shell-style pattern such as
+                         'api.*.requests' matched against list()
+           :param concurrency: reads in flight
+           Other arguments are those of series(). The rows of a bucket
+           are joined as the reads of the names complete: counts are
+           summed, histograms added, sets united, series concatenated and
+           the highest gauge kept, unless a join_rows(rows) is given.
+        """
+        pattern = None
+        if isinstance(names, string_types):
+            pattern = names
+            names = [name for name in self.list()
+                     if fnmatch.fnmatchcase(name, pattern)]
+        config = self._intervals.get(interval)
+        if not config:
+            raise UnknownInterval(interval)
+        buckets = series_buckets(config, kwargs.get('start'),
+                                 kwargs.get('end'), kwargs.get('steps'))
+        join_rows = kwargs.pop('join_rows', None) or self._join_names
+
+        session = self._hold_session()
+        try:
+            data = self._aggregate_rows(session, names, interval, buckets,
+                                        concurrency, join_rows)
+
+            def fetch(session, table, name, interval, buckets):
+                return data
+
+            return self.series(pattern, interval, fetch=fetch, **kwargs)
+        finally:
+            self._release_session()
+
+    def _forget(self, names):
+        '''Drops the write state kept for names, or for all names if None,
+           as their data is deleted'''
+
+    def cursor(self, name, interval, **kwargs):
+        '''Runs series() and returns a SeriesCursor whose poll() refreshes
+           the result re-reading only the newest buckets.'''
+        return SeriesCursor(self, name, interval, **kwargs)
+
     def delete(self, name):
-        query = SimpleStatement("DELETE FROM %s WHERE name='%s'" % (self._table, name),
-                                consistency_level=self.write_consistency_level)
-        self._get_session().execute(query)
+        query = self._statement(
+            "DELETE FROM %s WHERE name='%s'" % (self._table, name), True,
+            self.write_consistency_level)
+        self._execute(query, name=name)
+        self._forget([name])
+        self._shutdown_session()
+
+    def _delete_range_stmt(self, name, interval, before):
+        config = self._intervals.get(interval)
+        if not config:
+            raise UnknownInterval(interval)
+        i_bucket = config['i_calc'].to_bucket(before)
+        return self._statement(
+            """DELETE FROM %s
+               WHERE name = '%s' AND interval = '%s' AND i_time < %s
+            """ % (self._table, name, interval, i_bucket), True,
+            self.write_consistency_level)
+
+    def delete_range(self, name, interval, before):
+        '''Deletes the buckets of an interval older than the one timestamp
+           before falls in, with a single range tombstone.'''
+        self._execute(self._delete_range_stmt(name, interval, before),
+                      name=name)
+        self._forget([name])
         self._shutdown_session()
 
+    def purge(self, retention, names=None, now=None, concurrency=16,
+              rate=None, progress=None):
+        """Deletes the data older than a retention period, one range
+           tombstone per name and interval.
+           :param retention: {interval: seconds} of data to keep, other
+                             intervals are left alone
+           :param names: names to purge, all names of the table by default
+           :param concurrency: deletes in flight
+           :param rate: maximum deletes per second, to bound tombstone and
+                        compaction pressure
+           :param progress: callable(done, total) called as deletes complete
+           Returns the number of deletes issued.
+        """
+        now = time.time() if now is None else now
+        if names is None:
+            names = self.list()
+        statements = [
+            (self._delete_range_stmt(name, interval, now - seconds), ())
+            for name in names
+            for interval, seconds in sorted(retention.items())]
+
+        step = concurrency
+        if rate:
+            step = max(1, min(concurrency, int(rate)))
+        done = 0
+        start = time.time()
+        session = self._hold_session()
+        try:
+            for i in range(0, len(statements), step):
+                chunk = statements[i:i + step]
+                execute_concurrent(session, chunk, concurrency=concurrency,
+                                   raise_on_first_error=True)
+                done += len(chunk)
+                if progress:
+                    progress(done, len(statements))
+                if rate:
+                    delay = done / float(rate) - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            self._forget(names)
+            self._release_session()
+        return done
+
     def delete_all(self):
-        self._get_session().execute("TRUNCATE %s", [self._table])
+        self._execute(self._statement('TRUNCATE %s' % self._table, True,
+                                      self.write_consistency_level))
+        self._forget(None)
         self._shutdown_session()
 
     def list(self):
-        query = SimpleStatement("SELECT name FROM %s", consistency_level=self.read_consistency_level)
-        res = self._get_session().execute(query, [self._table])
+        query = self._read_statement('SELECT DISTINCT name FROM %s' % self._table)
+        names = [row.name for row in self._execute(query)]
         self._shutdown_session()
-        return [row.name for row in res]
+        return names
 
     def properties(self, name):
         rval = {}
 
         for interval, config in self._intervals.items():
             rval.setdefault(interval, {})
-            query_first = SimpleStatement(
+            query_first = self._read_statement(
                 '''SELECT i_time
                    FROM %s
                    WHERE name=%s AND interval=%s
                    ORDER BY interval ASC, i_time ASC
-                   LIMIT 1''',
-                consistency_level=self.read_consistency_level
+                   LIMIT 1'''
             )
-            i_time_first = self._get_session().execute(query_first,
-                                                       [self._table, name, interval])
+            i_time_first = self._execute(query_first,
+                                         [self._table, name, interval])
             
             rval[interval]['first'] = config['i_calc'].from_bucket(
                 i_time_first[0].i_time)
 
-            query_last = SimpleStatement(
+            query_last = self._read_statement(
                 '''SELECT i_time
                    FROM %s
                    WHERE name=%s AND interval=%s
                    ORDER BY interval ASC, i_time ASC
-                   LIMIT 1''',
-                consistency_level=self.read_consistency_level
+                   LIMIT 1'''
             )
-            i_time_last = self._get_session().execute(query_last,
-                                                      [self._table, name, interval])
+            i_time_last = self._execute(query_last,
+                                        [self._table, name, interval])
             rval[interval]['last'] = config['i_calc'].from_bucket(
                 i_time_last[0].i_time)
         self._shutdown_session()
@@ -214,6 +840,9 @@ class CassandraBackend(Timeseries):
 
 class CassandraSeries(CassandraBackend, Series):
 
+    _type_name = 'series'
+    _value_columns = 'value'
+
     def __new__(cls, *args, **kwargs):
         return Series.__new__(cls, *args, **kwargs)
 
@@ -223,20 +852,13 @@ class CassandraSeries(CassandraBackend, Series):
         self.default_columns.update(
             {'value': ('list<%s>' % self._value_type)})
 
-        if self._create_table:
-            create_table(self.cluster, self._keyspace, self._table,
-                         self.default_columns,
-                         ['name', 'interval', 'i_time', 'r_time'])
-
     def _insert_stmt(self, name, value, timestamp, interval, config):
         '''Helper to generate the insert statement.'''
         # Calculate the TTL and abort if inserting into the past
-        expire, ttl = config['expire'], config['ttl'](timestamp)
-        if expire and not ttl:
+        i_time, r_time, ttl = config['bucket_calc'].buckets(timestamp)
+        if config['expire'] and not ttl:
             return None
 
-        i_time, r_time = calculate_irtime(config, timestamp)
-
         table_spec = self._table
         if ttl:
             table_spec += " USING TTL %s " % (ttl)
@@ -248,31 +870,33 @@ class CassandraSeries(CassandraBackend, Series):
                                         interval, i_time, r_time)
         return stmt
 
-    def _type_get(self, name, interval, i_bucket, i_end=None):
-        rval = OrderedDict()
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        values = ', '.join('%s' % self._quote(v) for v in row or [])
+        return ['''UPDATE %s SET value = [%s]
+                   WHERE name = '%s' AND interval = '%s'
+                   AND i_time = %s AND r_time = %s''' % (
+                    self._table_spec(ttl), values, name, interval, i_time,
+                    r_time)]
 
-        query = """SELECT i_time, r_time, value
-                   FROM %(table)s
-                   WHERE name = '%(name)s'
-                   AND interval = '%(interval)s'"""
-        extra_query = 'AND i_time >= %(i_bucket)s AND i_time <= %(i_end)s' if i_end else 'AND i_time = %(i_bucket)s'
-        order_query = 'ORDER BY interval, i_time, r_time'
-        query = ' '.join([query, extra_query, order_query])
-
-        stmt = query % {'name': name, 'table': self._table,
-                        'interval': interval, 'i_bucket': i_bucket,
-                        'i_end': i_end}
-        stmt = SimpleStatement(stmt, consistency_level=self.read_consistency_level)
-        rows = self._get_session().execute(stmt)
+    def _export_records(self, row):
+        '''(value, count) records of a row, see export'''
+        return [(v, 1) for v in row.value or []]
+
+    def _type_rows(self, rows):
+        rval = OrderedDict()
         for row in rows:
             r_time = None if row.r_time == -1 else row.r_time
             rval.setdefault(row.i_time, OrderedDict())[r_time] = row.value
-        self._shutdown_session()
         return rval
 
 
 class CassandraHistogram(CassandraBackend, Histogram):
 
+    _counter = True
+    _type_name = 'histogram'
+    _value_columns = 'value, count'
+    _primary_key = ['name', 'interval', 'i_time', 'r_time', 'value']
+
     def __init__(self, *args, **kwargs):
         self._table = 'histogram'
         super(CassandraHistogram, self).__init__(*args, **kwargs)
@@ -280,20 +904,13 @@ class CassandraHistogram(CassandraBackend, Histogram):
         self.default_columns.update(
             {'value': self._value_type, 'count': 'counter'})
 
-        if self._create_table:
-            create_table(self.cluster, self._keyspace, self._table,
-                         self.default_columns,
-                         ['name', 'interval', 'i_time', 'r_time', 'value'])
-
     def _insert_stmt(self, name, value, timestamp, interval, config):
         '''Helper to generate the insert statement.'''
         # Calculate the TTL and abort if inserting into the past
-        expire, ttl = config['expire'], config['ttl'](timestamp)
-        if expire and not ttl:
+        i_time, r_time, ttl = config['bucket_calc'].buckets(timestamp)
+        if config['expire'] and not ttl:
             return None
 
-        i_time, r_time = calculate_irtime(config, timestamp)
-
         table_spec = self._table
         if ttl:
             table_spec += " USING TTL %s " % (ttl)
@@ -307,51 +924,91 @@ class CassandraHistogram(CassandraBackend, Histogram):
                                        r_time, value)
         return stmt
 
-    def _type_get(self, name, interval, i_bucket, i_end=None):
-        rval = OrderedDict()
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        return ['''UPDATE %s SET count = count + %s
+                   WHERE name = '%s' AND interval = '%s'
+                   AND i_time = %s AND r_time = %s AND value = %s''' % (
+                    self._table_spec(ttl), count, name, interval, i_time,
+                    r_time, self._quote(value))
+                for value, count in row.items()]
 
-        stmt = """SELECT i_time, r_time, value, count
-                  FROM %s
-                  WHERE name = '%s' AND interval = '%s'
-               """ % (self._table, name, interval)
-        if i_end:
-            stmt += ' AND i_time >= %s AND i_time <= %s' % (i_bucket, i_end)
-        else:
-            stmt += ' AND i_time = %s' % (i_bucket)
-        stmt += ' ORDER BY interval, i_time, r_time'
-        
-        stmt = SimpleStatement(stmt, consistency_level=self.read_consistency_level)
-        rows = self._get_session().execute(stmt)
+    def _export_records(self, row):
+        '''(value, count) records of a row, see export'''
+        return [(row.value, row.count)]
+
+    def _type_rows(self, rows):
+        rval = OrderedDict()
         for row in rows:
             r_time = None if row.r_time == -1 else row.r_time
             rval.setdefault(row.i_time, OrderedDict()).setdefault(
                 r_time, {})[row.value] = row.count
-        self._shutdown_session()
         return rval
 
+    def _transform(self, data, transform, step_size):
+        '''
+        Adds percentile transforms such as 'p50' or 'p99.9' to the
+        ones supported by kairos.
+        '''
+        match = isinstance(transform, str) and PERCENTILE_MATCH.match(transform)
+        if match:
+            return histogram_percentile(data, float(match.group(1)))
+        return super(CassandraHistogram, self)._transform(
+            data, transform, step_size)
+
+
+class CassandraHistogramSketch(CassandraHistogram):
+    """Histogram that quantizes values into logarithmic bins before
+       writing, so a high-cardinality float metric keeps a bounded number
+       of counter cells per bucket. Read values are the bins'
+       representative values, within ``sketch_accuracy`` (relative) of
+       the inserted ones. Only non-negative values are supported.
+       Selected with ``type='histogram', sketch=True``."""
+
+    # Exported values are the bins' representative values
+    _export_value_type = 'double'
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('table_name', 'histogram_sketch')
+        # The value column holds bin keys
+        kwargs['value_type'] = 'int'
+        self._bins = LogBins(kwargs.get('sketch_accuracy', 0.01),
+                             kwargs.get('sketch_min_value', 1e-9))
+        super(CassandraHistogramSketch, self).__init__(*args, **kwargs)
+
+    def _insert_stmt(self, name, value, timestamp, interval, config):
+        return super(CassandraHistogramSketch, self)._insert_stmt(
+            name, self._bins.key(value), timestamp, interval, config)
+
+    def _export_records(self, row):
+        '''(value, count) records of a row, see export'''
+        return [(self._bins.value(row.value), row.count)]
+
+    def _process_row(self, data):
+        rval = {}
+        for key, count in data.items():
+            rval[self._bins.value(key)] = count
+        return super(CassandraHistogramSketch, self)._process_row(rval)
+
 
 class CassandraCount(CassandraBackend, Count):
 
+    _counter = True
+    _type_name = 'count'
+    _value_columns = 'count'
+
     def __init__(self, *args, **kwargs):
         self._table = 'count'
         super(CassandraCount, self).__init__(*args, **kwargs)
 
         self.default_columns.update({'count': 'counter'})
 
-        if self._create_table:
-            create_table(self.cluster, self._keyspace, self._table,
-                         self.default_columns,
-                         ['name', 'interval', 'i_time', 'r_time'])
-
     def _insert_stmt(self, name, value, timestamp, interval, config):
         '''Helper to generate the insert statement.'''
         # Calculate the TTL and abort if inserting into the past
-        expire, ttl = config['expire'], config['ttl'](timestamp)
-        if expire and not ttl:
+        i_time, r_time, ttl = config['bucket_calc'].buckets(timestamp)
+        if config['expire'] and not ttl:
             return None
 
-        i_time, r_time = calculate_irtime(config, timestamp)
-
         table_spec = self._table
         if ttl:
             table_spec += " USING TTL %s " % (ttl)
@@ -364,50 +1021,78 @@ class CassandraCount(CassandraBackend, Count):
                                         i_time, r_time)
         return stmt
 
-    def _type_get(self, name, interval, i_bucket, i_end=None):
-        rval = OrderedDict()
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        if not row:
+            return []
+        return ['''UPDATE %s SET count = count + %s
+                   WHERE name = '%s' AND interval = '%s'
+                   AND i_time = %s AND r_time = %s''' % (
+                    self._table_spec(ttl), row, name, interval, i_time,
+                    r_time)]
 
-        stmt = """SELECT i_time, r_time, count
-                  FROM %s
-                  WHERE name = '%s' AND interval = '%s'
-               """ % (self._table, name, interval)
-        if i_end:
-            stmt += ' AND i_time >= %s AND i_time <= %s'%(i_bucket, i_end)
-        else:
-            stmt += ' AND i_time = %s'%(i_bucket)
-        stmt += ' ORDER BY interval, i_time, r_time'
+    def _export_records(self, row):
+        '''(value, count) records of a row, see export'''
+        return [(0, row.count)]
 
-        stmt = SimpleStatement(stmt, consistency_level=self.read_consistency_level)
-        rows = self._get_session().execute(stmt)
+    def _type_rows(self, rows):
+        rval = OrderedDict()
         for row in rows:
             r_time = None if row.r_time == -1 else row.r_time
             rval.setdefault(row.i_time, OrderedDict())[r_time] = row.count
-        self._shutdown_session()
         return rval
 
 
 class CassandraGauge(CassandraBackend, Gauge):
 
+    _idempotent_insert = True
+    _overwrite = True
+    _type_name = 'gauge'
+    _value_columns = 'value'
+
     def __init__(self, *args, **kwargs):
         self._table = 'gauge'
         super(CassandraGauge, self).__init__(*args, **kwargs)
 
         self.default_columns.update({'value': self._value_type})
 
-        if self._create_table:
-            create_table(self.cluster, self._keyspace, self._table,
-                         self.default_columns,
-                         ['name', 'interval', 'i_time', 'r_time'])
+        # Last value written per bucket, to skip rewriting unchanged values
+        dedupe_cache_size = kwargs.get('dedupe_cache_size', 0)
+        self._last_values = (LRUCache(dedupe_cache_size)
+                             if dedupe_cache_size else None)
+
+    def _insert_data(self, name, value, timestamp, interval, config):
+        if self._last_values is None:
+            return super(CassandraGauge, self)._insert_data(
+                name, value, timestamp, interval, config)
+
+        key = (name, interval) + config['bucket_calc'].buckets(timestamp)[:2]
+        if key in self._last_values and self._last_values.get(key) == value:
+            self.stats['suppressed_writes'] += 1
+            return
+
+        def applied():
+            self._last_values[key] = value
+        super(CassandraGauge, self)._insert_data(
+            name, value, timestamp, interval, config, applied)
+
+    def _forget(self, names):
+        if self._last_values is None:
+            return
+        if names is None:
+            self._last_values.clear()
+            return
+        names = set(names)
+        for key in self._last_values.keys():
+            if key[0] in names:
+                self._last_values.pop(key)
 
     def _insert_stmt(self, name, value, timestamp, interval, config):
         '''Helper to generate the insert statement.'''
         # Calculate the TTL and abort if inserting into the past
-        expire, ttl = config['expire'], config['ttl'](timestamp)
-        if expire and not ttl:
+        i_time, r_time, ttl = config['bucket_calc'].buckets(timestamp)
+        if config['expire'] and not ttl:
             return None
 
-        i_time, r_time = calculate_irtime(config, timestamp)
-
         table_spec = self._table
         if ttl:
             table_spec += " USING TTL %s " % ttl
@@ -420,50 +1105,111 @@ class CassandraGauge(CassandraBackend, Gauge):
                                         i_time, r_time)
         return stmt
 
-    def _type_get(self, name, interval, i_bucket, i_end=None):
-        rval = OrderedDict()
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        if row is None:
+            return []
+        return ['''UPDATE %s SET value = %s
+                   WHERE name = '%s' AND interval = '%s'
+                   AND i_time = %s AND r_time = %s''' % (
+                    self._table_spec(ttl), self._quote(row), name, interval,
+                    i_time, r_time)]
 
-        stmt = """SELECT i_time, r_time, value
-                  FROM %s
-                  WHERE name = '%s' AND interval = '%s'
-               """ % (self._table, name, interval)
-        if i_end:
-            stmt += ' AND i_time >= %s AND i_time <= %s' % (i_bucket, i_end)
-        else:
-            stmt += ' AND i_time = %s'%(i_bucket)
-        stmt += ' ORDER BY interval, i_time, r_time'
+    def _export_records(self, row):
+        '''(value, count) records of a row, see export'''
+        return [(row.value, 1)]
 
-        stmt = SimpleStatement(stmt, consistency_level=self.read_consistency_level)
-        rows = self._get_session().execute(stmt)
+    def _type_rows(self, rows):
+        rval = OrderedDict()
         for row in rows:
             r_time = None if row.r_time == -1 else row.r_time
             rval.setdefault(row.i_time, OrderedDict())[r_time] = row.value
-        self._shutdown_session()
         return rval
 
+    def _join_names(self, rows):
+        '''Keeps the highest value, the latest write across names isn't
+           known'''
+        values = [row for row in rows if row is not None]
+        return max(values) if values else None
+
 
 class CassandraSet(CassandraBackend, Set):
 
+    _idempotent_insert = True
+    _type_name = 'set'
+    _value_columns = 'value'
+    _primary_key = ['name', 'interval', 'i_time', 'r_time', 'value']
+
     def __init__(self, *args, **kwargs):
         self._table = 'sets'
         super(CassandraSet, self).__init__(*args, **kwargs)
 
         self.default_columns.update({'value': self._value_type})
 
-        if self._create_table:
-            create_table(self.cluster, self._keyspace, self._table,
-                         self.default_columns,
-                         ['name', 'interval', 'i_time', 'r_time', 'value'])
+        # Members already written to the latest bucket of each interval,
+        # either an exact 'lru' set or an approximate 'bloom' filter.
+        self._membership_filter = kwargs.get('membership_filter')
+        if self._membership_filter not in (None, 'lru', 'bloom'):
+            raise ValueError(
+                "Unknown membership filter %s" % self._membership_filter)
+        self._membership_filter_size = kwargs.get(
+            'membership_filter_size', 100000)
+        self._membership_filter_error = kwargs.get(
+            'membership_filter_error', 0.001)
+        self._members = {}
+
+    def _new_members(self):
+        if self._membership_filter == 'bloom':
+            return BloomFilter(self._membership_filter_size,
+                               self._membership_filter_error)
+        return LRUSet(self._membership_filter_size)
+
+    def _insert_data(self, name, value, timestamp, interval, config):
+        if self._membership_filter is None:
+            return super(CassandraSet, self)._insert_data(
+                name, value, timestamp, interval, config)
+
+        i_time, r_time = config['bucket_calc'].buckets(timestamp)[:2]
+        current = self._members.get(interval)
+        if current is None or i_time > current[0]:
+            # Rotate to the new bucket, members of the old one are dropped
+            current = self._members[interval] = (i_time, self._new_members())
+        elif i_time < current[0]:
+            # Late writes to older buckets are not filtered
+            return super(CassandraSet, self)._insert_data(
+                name, value, timestamp, interval, config)
+
+        members = current[1]
+        if self._membership_filter == 'bloom' and members.full():
+            # Past its capacity the filter would take more new members
+            # for written ones, start a new one
+            members = self._new_members()
+            self._members[interval] = (i_time, members)
+            self.stats['membership_filter_resets'] += 1
+        if (name, r_time, value) in members:
+            self.stats['suppressed_writes'] += 1
+            return
+        super(CassandraSet, self)._insert_data(
+            name, value, timestamp, interval, config,
+            lambda: members.add((name, r_time, value)))
+
+    def _forget(self, names):
+        if names is None or self._membership_filter == 'bloom':
+            # Members can't be removed from a Bloom filter
+            self._members.clear()
+            return
+        names = set(names)
+        for _, members in self._members.values():
+            for key in members.keys():
+                if key[0] in names:
+                    members.pop(key)
 
     def _insert_stmt(self, name, value, timestamp, interval, config):
         '''Helper to generate the insert statement.'''
         # Calculate the TTL and abort if inserting into the past
-        expire, ttl = config['expire'], config['ttl'](timestamp)
-        if expire and not ttl:
+        i_time, r_time, ttl = config['bucket_calc'].buckets(timestamp)
+        if config['expire'] and not ttl:
             return None
 
-        i_time, r_time = calculate_irtime(config, timestamp)
-
         stmt = """INSERT INTO %s (name, interval, i_time, r_time, value)
                   VALUES ('%s', '%s', %s, %s, %s)
                """ % (self._table, name, interval, i_time, r_time, value)
@@ -472,27 +1218,192 @@ class CassandraSet(CassandraBackend, Set):
             stmt += " USING TTL %s" % ttl
         return stmt
 
-    def _type_get(self, name, interval, i_bucket, i_end=None):
-        rval = OrderedDict()
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        rval = []
+        for value in row:
+            stmt = """INSERT INTO %s (name, interval, i_time, r_time, value)
+                      VALUES ('%s', '%s', %s, %s, %s)
+                   """ % (self._table, name, interval, i_time, r_time,
+                          self._quote(value))
+            if ttl:
+                stmt += " USING TTL %s" % ttl
+            rval.append(stmt)
+        return rval
 
-        stmt = """SELECT i_time, r_time, value
-                  FROM %s
-                  WHERE name = '%s' AND interval = '%s'
-               """ % (self._table, name, interval)
-        if i_end:
-            stmt += ' AND i_time >= %s AND i_time <= %s' % (i_bucket, i_end)
-        else:
-            stmt += ' AND i_time = %s' % (i_bucket)
-        stmt += ' ORDER BY interval, i_time, r_time'
+    def _export_records(self, row):
+        '''(value, count) records of a row, see export'''
+        return [(row.value, 1)]
 
-        stmt = SimpleStatement(stmt, consistency_level=self.read_consistency_level)
-        rows = self._get_session().execute(stmt)
+    def _type_rows(self, rows):
+        rval = OrderedDict()
         for row in rows:
             r_time = None if row.r_time == -1 else row.r_time
             rval.setdefault(row.i_time, OrderedDict()).setdefault(
                 r_time, set()).add(row.value)
-        self._shutdown_session()
         return rval
 
 
-BACKENDS.update({'cassandra': CassandraBackend})
+class CassandraSetSketch(CassandraBackend, Set):
+    """Set that stores a HyperLogLog sketch per bucket instead of members.
+       Each client keeps the sketches of the buckets it writes in memory
+       and overwrites its own row (keyed by ``writer_id``) only when the
+       sketch changes; reads merge the rows of all writers. Rows are
+       returned as HyperLogLog instances, use ``len()`` or the 'count'
+       transform to get the approximate cardinality.
+       Selected with ``type='set', sketch=True``."""
+
+    _idempotent_insert = True
+    _overwrite = True
+    # Sketches have no members to export
+    _exportable = False
+    _type_name = 'set'
+    _value_columns = 'sketch'
+    _primary_key = ['name', 'interval', 'i_time', 'r_time', 'writer']
+
+    def __init__(self, *args, **kwargs):
+        self._table = 'set_sketch'
+        super(CassandraSetSketch, self).__init__(*args, **kwargs)
+        self._precision = kwargs.get('sketch_precision', 12)
+        self._sketches = LRUCache(kwargs.get('sketch_cache_size', 1000))
+        # A generated writer id has no rows but those cached since
+        self._new_writer = not kwargs.get('writer_id')
+
+        self.default_columns.update({'writer': 'text', 'sketch': 'blob'})
+
+    def _load_sketch(self, name, interval, i_time, r_time):
+        '''Reads back the sketch this writer stored for a bucket'''
+        stmt = """SELECT sketch FROM %s
+                  WHERE name = '%s' AND interval = '%s'
+                  AND i_time = %s AND r_time = %s AND writer = '%s'
+               """ % (self._table, name, interval,
+                      i_time, r_time, self._writer_id)
+        rows = list(self._execute(self._read_statement(stmt), name=name))
+        if rows and rows[0].sketch:
+            return HyperLogLog.from_bytes(rows[0].sketch)
+        return HyperLogLog(self._precision)
+
+    def _cached_sketch(self, key):
+        '''Sketch of a bucket as this writer last wrote it, read back
+           only if it may have been written but is no longer cached'''
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            if self._new_writer and not self._sketches.evictions:
+                sketch = HyperLogLog(self._precision)
+            else:
+                sketch = self._load_sketch(*key)
+            self._sketches[key] = sketch
+        return sketch
+
+    def _sketch_insert(self, name, value, timestamp, interval, config):
+        '''(key, sketch, stmt) writing a copy of the sketch of the bucket
+           with value added, None if the value did not raise a register'''
+        # Calculate the TTL and abort if inserting into the past
+        i_time, r_time, ttl = config['bucket_calc'].buckets(timestamp)
+        if config['expire'] and not ttl:
+            return None
+
+        key = (name, interval, i_time, r_time)
+        sketch = self._cached_sketch(key).copy()
+        if not sketch.add(value):
+            return None
+
+        stmt = """INSERT INTO %s (name, interval, i_time, r_time, writer, sketch)
+                  VALUES ('%s', '%s', %s, %s, '%s', 0x%s)
+               """ % (self._table, name, interval, i_time, r_time,
+                      self._writer_id,
+                      binascii.hexlify(sketch.to_bytes()).decode('ascii'))
+        if ttl:
+            stmt += " USING TTL %s" % ttl
+        return key, sketch, stmt
+
+    def _insert_data(self, name, value, timestamp, interval, config):
+        insert = self._sketch_insert(name, value, timestamp, interval, config)
+        if insert is None:
+            return
+        key, sketch, stmt = insert
+
+        def applied():
+            self._sketches[key] = sketch
+        self._write(stmt, name, applied)
+        if self._leaderboard is not None:
+            self._count_leader(name, value, timestamp, interval, config)
+
+    def _insert_stmt(self, name, value, timestamp, interval, config):
+        '''Helper to generate the insert statement. Its statements being
+           run later, the bulk paths cache the sketch right away.'''
+        insert = self._sketch_insert(name, value, timestamp, interval, config)
+        if insert is None:
+            return None
+        key, sketch, stmt = insert
+        self._sketches[key] = sketch
+        return stmt
+
+    def _copy_row_stmts(self, name, interval, i_time, r_time, ttl, row):
+        '''The sketches of all writers, merged, go in this writer's row'''
+        stmt = """INSERT INTO %s (name, interval, i_time, r_time, writer, sketch)
+                  VALUES ('%s', '%s', %s, %s, '%s', 0x%s)
+               """ % (self._table, name, interval, i_time, r_time,
+                      self._writer_id,
+                      binascii.hexlify(row.to_bytes()).decode('ascii'))
+        if ttl:
+            stmt += " USING TTL %s" % ttl
+        return [stmt]
+
+    def _forget(self, names):
+        if names is None:
+            self._sketches.clear()
+            return
+        names = set(names)
+        for key in self._sketches.keys():
+            if key[0] in names:
+                self._sketches.pop(key)
+
+    def _type_rows(self, rows):
+        rval = OrderedDict()
+        for row in rows:
+            r_time = None if row.r_time == -1 else row.r_time
+            sketch = HyperLogLog.from_bytes(row.sketch)
+            i_data = rval.setdefault(row.i_time, OrderedDict())
+            if r_time in i_data:
+                i_data[r_time].merge(sketch)
+            else:
+                i_data[r_time] = sketch
+        return rval
+
+    def _type_no_value(self):
+        return HyperLogLog(self._precision)
+
+    def _transform(self, data, transform, step_size):
+        '''
+        Transform the data. Only cardinality based transforms are
+        supported, others return the sketch unaltered.
+        '''
+        if transform == 'count':
+            data = len(data)
+        elif transform == 'rate':
+            data = len(data) / float(step_size)
+        elif callable(transform):
+            data = transform(data)
+        return data
+
+    def _process_row(self, data):
+        return data
+
+    def _condense(self, data):
+        '''
+        Condense by merging all of the sketches.
+        '''
+        return self._join(data.values())
+
+    def _join(self, rows):
+        '''
+        Join multiple rows worth of data into a single result.
+        '''
+        rval = HyperLogLog(self._precision)
+        for row in rows:
+            if row:
+                rval.merge(row)
+        return rval
+
+
+register(BACKENDS)
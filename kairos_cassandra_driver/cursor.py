@@ -0,0 +1,72 @@
+'''Incremental reads of a series window for live dashboards'''
+
+import copy
+from collections import OrderedDict
+
+
+class SeriesCursor(object):
+    """Handle on the result of a series() call that can be refreshed
+       cheaply. Raw rows of the buckets read are kept, and a poll only
+       re-queries the buckets from the newest bucket of the previous
+       window onwards: older buckets were closed when they were read.
+       Writes landing in a bucket after it was closed are not seen.
+
+       Takes the arguments of series(), except collapse. Without an
+       explicit end the window slides with the clock, so the cost of a
+       poll does not depend on the number of steps.
+    """
+
+    def __init__(self, series, name, interval, **kwargs):
+        if kwargs.get('collapse'):
+            raise ValueError("Cursors don't support collapse")
+        self.series = series
+        self.name = name
+        self.interval = interval
+        self.kwargs = kwargs
+        self._rows = {}
+        self._open = None
+        self._window = None
+        self.result = OrderedDict()
+        self.poll()
+
+    def _fetch(self, session, table, name, interval, buckets):
+        rows, read = self._rows.setdefault(name, ({}, set()))
+        for i_bucket in list(read):
+            if i_bucket < buckets[0]:
+                read.discard(i_bucket)
+                rows.pop(i_bucket, None)
+
+        stale = [b for b in buckets if b not in read or
+                 (self._open is not None and b >= self._open)]
+        if stale:
+            data = self.series._type_get(name, interval, stale[0], stale[-1])
+            for i_bucket in stale:
+                rows.pop(i_bucket, None)
+            rows.update(data)
+            read.update(b for b in buckets if stale[0] <= b <= stale[-1])
+        self._window = buckets
+
+        # Reading may condense rows in place, so hand out copies
+        rval = OrderedDict()
+        for i_bucket in buckets:
+            if i_bucket in rows:
+                rval[i_bucket] = OrderedDict(
+                    (r_bucket, copy.copy(row))
+                    for r_bucket, row in rows[i_bucket].items())
+        return rval
+
+    def poll(self, **kwargs):
+        '''Refreshes the result, optionally with new series() arguments
+           such as end. Returns the buckets that are new or changed since
+           the previous poll.'''
+        self.kwargs.update(kwargs)
+        result = self.series.series(self.name, self.interval,
+                                    fetch=self._fetch, **self.kwargs)
+        self._open = self._window[-1]
+
+        delta = OrderedDict()
+        for key, data in result.items():
+            if key not in self.result or self.result[key] != data:
+                delta[key] = data
+        self.result = result
+        return delta
@@ -0,0 +1,330 @@
+'''
+Bulk export of series to a compact columnar file, and a reader that
+memory-maps such a file to answer get/series queries without loading it.
+
+File layout, little-endian:
+
+    magic      8 bytes  'KCDX0001'
+    records    uint64   number of records N
+    index      uint64   offset of the index
+    i_time     int64[N]
+    r_time     int64[N]
+    value      float64[N]
+    count      int64[N]
+    index      utf-8 JSON: series type, value type, intervals config and
+               the [name, interval, first, last) record range of each
+               series, sorted by (i_time, r_time)
+
+Each record is one value of a bucket with its count: a list element of
+a series, a histogram value, a gauge value, a set member, or a counter
+(with value 0).
+'''
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from collections import OrderedDict
+
+from .helpers import parse_intervals
+
+MAGIC = b'KCDX0001'
+HEADER = struct.Struct('<8sQQ')
+COLUMNS = (('i_time', 'q'), ('r_time', 'q'), ('value', 'd'), ('count', 'q'))
+INT_TYPES = set(['int', 'bigint', 'varint'])
+NUMERIC_TYPES = INT_TYPES | set(['float', 'double', 'decimal'])
+
+
+def export(series, path, names=None, intervals=None, start=None, end=None,
+           fetch_size=5000):
+    """Streams series data into a columnar file at path
+       :param series: CassandraBackend instance
+       :param names: names to export, all names of the table by default
+       :param intervals: intervals to export, all configured by default
+       :param start: timestamp of the first bucket to export
+       :param end: timestamp of the last bucket to export
+       :param fetch_size: rows per page read from Cassandra
+       Returns the number of records written.
+    """
+    if series._type_name not in ROW_BUILDERS:
+        raise TypeError("Can't export %s series" % series._type_name)
+    if not series._exportable:
+        raise TypeError("Can't export %s series" % type(series).__name__)
+    value_type = series._export_value_type or series._value_type
+    if value_type not in NUMERIC_TYPES and series._type_name != 'count':
+        raise TypeError("Can't export values of type %s" % value_type)
+
+    if names is None:
+        stmt = series._read_statement(
+            'SELECT DISTINCT name FROM %s' % series._table,
+            fetch_size=fetch_size)
+        names = (row.name for row in series._execute(stmt))
+    intervals = intervals or sorted(series._intervals)
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        columns = [open(os.path.join(tmpdir, column), 'wb')
+                   for column, _ in COLUMNS]
+        ranges = []
+        count = 0
+        for name in names:
+            for interval in intervals:
+                config = series._intervals[interval]
+                query = """SELECT i_time, r_time, %s FROM %s
+                           WHERE name = '%s' AND interval = '%s'
+                        """ % (series._value_columns, series._table,
+                               name, interval)
+                if start is not None:
+                    query += ' AND i_time >= %s' % (
+                        config['i_calc'].to_bucket(start))
+                if end is not None:
+                    query += ' AND i_time <= %s' % (
+                        config['i_calc'].to_bucket(end))
+                query += ' ORDER BY interval, i_time, r_time'
+                stmt = series._read_statement(query, fetch_size=fetch_size)
+
+                first = count
+                for row in series._execute(stmt):
+                    for value, value_count in series._export_records(row):
+                        for f, (_, fmt), v in zip(
+                                columns, COLUMNS,
+                                (row.i_time, row.r_time, value, value_count)):
+                            f.write(struct.pack('<' + fmt, v))
+                        count += 1
+                if count > first:
+                    ranges.append([name, interval, first, count])
+        for f in columns:
+            f.close()
+
+        index = json.dumps({
+            'type': series._type_name,
+            'value_type': value_type,
+            'intervals': dict(
+                (interval, {'step': config['step'],
+                            'resolution': config['resolution']})
+                for interval, config in series._intervals.items()),
+            'series': ranges,
+        }).encode('utf-8')
+
+        with open(path, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, count, HEADER.size + count * 32))
+            for column, _ in COLUMNS:
+                with open(os.path.join(tmpdir, column), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+            out.write(index)
+    finally:
+        shutil.rmtree(tmpdir)
+        series._shutdown_session()
+    return count
+
+
+def _series_row(values, counts, value_type):
+    return list(values)
+
+
+def _histogram_row(values, counts, value_type):
+    rval = {}
+    for value, count in zip(values, counts):
+        rval[value] = rval.get(value, 0) + count
+    return rval
+
+
+def _count_row(values, counts, value_type):
+    return sum(counts)
+
+
+def _gauge_row(values, counts, value_type):
+    return values[-1] if values else None
+
+
+def _set_row(values, counts, value_type):
+    return set(values)
+
+
+ROW_BUILDERS = {
+    'series': _series_row,
+    'histogram': _histogram_row,
+    'count': _count_row,
+    'gauge': _gauge_row,
+    'set': _set_row,
+}
+
+
+def _calc(step):
+    from kairos.timeseries import GREGORIAN_TIMES, GregorianTime, RelativeTime
+
+    if step in GREGORIAN_TIMES:
+        return GregorianTime(step)
+    return RelativeTime(step)
+
+
+class SeriesFile(object):
+    """Read-only view of an exported file. The file is memory-mapped and
+       only the records of the buckets asked for are decoded, so it can
+       be much larger than memory.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, index_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a series export' % path)
+        index = json.loads(self._mmap[index_offset:].decode('utf-8'))
+        self.type = index['type']
+        self.value_type = index['value_type']
+        self._build_row = ROW_BUILDERS[self.type]
+        self._intervals = {}
+        for interval, config in index['intervals'].items():
+            self._intervals[interval] = {
+                'i_calc': _calc(config['step']),
+                'r_calc': _calc(config['resolution']),
+                'coarse': config['step'] == config['resolution'],
+            }
+        self._ranges = dict(((name, interval), (first, last))
+                            for name, interval, first, last in index['series'])
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def names(self):
+        return sorted(set(name for name, _ in self._ranges))
+
+    def _column(self, column, first, last):
+        position = [c for c, _ in COLUMNS].index(column)
+        fmt = COLUMNS[position][1]
+        offset = HEADER.size + (position * self._count + first) * 8
+        return struct.unpack_from('<%d%s' % (last - first, fmt),
+                                  self._mmap, offset)
+
+    def _buckets(self, name, interval, i_start, i_end):
+        '''Returns {i_bucket: {r_bucket: row}} for a range of buckets'''
+        first, last = self._ranges.get((name, interval), (0, 0))
+        i_times = _Column(self, 'i_time', first)
+        lo = bisect.bisect_left(i_times, i_start, 0, last - first) + first
+        hi = bisect.bisect_right(i_times, i_end, 0, last - first) + first
+
+        rval = OrderedDict()
+        if lo == hi:
+            return rval
+        i_times = self._column('i_time', lo, hi)
+        r_times = self._column('r_time', lo, hi)
+        values = self._column('value', lo, hi)
+        counts = self._column('count', lo, hi)
+        if self.value_type in INT_TYPES:
+            values = [int(v) for v in values]
+
+        cells = OrderedDict()
+        for i_time, r_time, value, count in zip(i_times, r_times, values,
+                                                counts):
+            cell = cells.setdefault((i_time, r_time), ([], []))
+            cell[0].append(value)
+            cell[1].append(count)
+        for (i_time, r_time), (cell_values, cell_counts) in cells.items():
+            rval.setdefault(i_time, OrderedDict())[
+                None if r_time == -1 else r_time] = self._build_row(
+                    cell_values, cell_counts, self.value_type)
+        return rval
+
+    def get(self, name, interval, timestamp):
+        '''Data of the bucket timestamp falls in, in the form returned by
+           Timeseries.get'''
+        config = self._intervals[interval]
+        i_bucket = config['i_calc'].to_bucket(timestamp)
+        data = self._buckets(name, interval, i_bucket, i_bucket).get(
+            i_bucket, {})
+        rval = OrderedDict()
+        if config['coarse']:
+            rval[config['i_calc'].from_bucket(i_bucket)] = data.get(None)
+        else:
+            for r_bucket, row in data.items():
+                rval[config['r_calc'].from_bucket(r_bucket)] = row
+        return rval
+
+    def series(self, name, interval, start=None, end=None):
+        '''Data of the buckets between start and end, in the form returned
+           by Timeseries.series'''
+        config = self._intervals[interval]
+        i_start = -2 ** 63
+        if start is not None:
+            i_start = config['i_calc'].to_bucket(start)
+        i_end = 2 ** 63 - 1
+        if end is not None:
+            i_end = config['i_calc'].to_bucket(end)
+        rval = OrderedDict()
+        buckets = self._buckets(name, interval, i_start, i_end)
+        for i_bucket, data in buckets.items():
+            i_key = config['i_calc'].from_bucket(i_bucket)
+            if config['coarse']:
+                rval[i_key] = data.get(None)
+            else:
+                rval[i_key] = OrderedDict(
+                    (config['r_calc'].from_bucket(r_bucket), row)
+                    for r_bucket, row in data.items())
+        return rval
+
+
+class _Column(object):
+    '''Sequence view of a column of the mapped file, for bisect'''
+
+    def __init__(self, reader, column, first):
+        position = [c for c, _ in COLUMNS].index(column)
+        self._fmt = '<' + COLUMNS[position][1]
+        self._offset = HEADER.size + (position * reader._count + first) * 8
+        self._mmap = reader._mmap
+
+    def __getitem__(self, i):
+        return struct.unpack_from(self._fmt, self._mmap,
+                                  self._offset + i * 8)[0]
+
+
+def main(argv=None):
+    '''Command line entry point of the export'''
+    from cassandra.cluster import Cluster
+    from .cassandra_timeseries import Timeseries
+
+    parser = argparse.ArgumentParser(
+        description='Export series from Cassandra to a columnar file')
+    parser.add_argument('path', help='file to write')
+    parser.add_argument('--hosts', default='127.0.0.1',
+                        help='comma separated contact points')
+    parser.add_argument('--port', type=int, default=9042)
+    parser.add_argument('--keyspace', default='kairos')
+    parser.add_argument('--type', required=True,
+                        choices=sorted(ROW_BUILDERS))
+    parser.add_argument('--table', help='table name, defaults to the type one')
+    parser.add_argument('--value-type', default='float')
+    parser.add_argument('--interval', action='append', required=True,
+                        help='name=step[:resolution], repeatable')
+    parser.add_argument('--name', action='append', dest='names',
+                        help='series name, repeatable, all by default')
+    parser.add_argument('--start', type=float)
+    parser.add_argument('--end', type=float)
+    parser.add_argument('--fetch-size', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    kwargs = {'type': args.type, 'intervals': parse_intervals(args.interval),
+              'keyspace': args.keyspace, 'value_type': args.value_type,
+              'create_table': False}
+    if args.table:
+        kwargs['table_name'] = args.table
+
+    cluster = Cluster(args.hosts.split(','), port=args.port)
+    try:
+        series = Timeseries(cluster, **kwargs)
+        count = export(series, args.path, names=args.names,
+                       start=args.start, end=args.end,
+                       fetch_size=args.fetch_size)
+    finally:
+        cluster.shutdown()
+    sys.stdout.write('%d records written to %s\n' % (count, args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+import math
+import time
 
 
 def calculate_irtime(config, timestamp):
@@ -8,3 +11,180 @@ def calculate_irtime(config, timestamp):
     else:
         r_time = -1
     return i_time, r_time
+
+
+class BucketCalculator(object):
+    """Memo of the bucket math of an interval. The (i_time, r_time, ttl)
+       of a timestamp is reused for the following timestamps until one
+       crosses a bucket edge, and the ttl until the clock crosses an
+       i_time edge, as kairos counts it in whole steps. Only intervals
+       with relative steps are memoized, gregorian ones are computed
+       every time.
+    """
+
+    def __init__(self, config):
+        from kairos.timeseries import RelativeTime
+        self.config = config
+        self._relative = (isinstance(config['i_calc'], RelativeTime) and
+                          isinstance(config['r_calc'], RelativeTime))
+        # (first, last, expires, (i_time, r_time, ttl)), replaced whole
+        # so that concurrent inserts always see a consistent entry
+        self._memo = None
+        self._primed = {}
+
+    def _compute(self, timestamp):
+        i_time, r_time = calculate_irtime(self.config, timestamp)
+        return i_time, r_time, self.config['ttl'](timestamp)
+
+    def _ttl_expires(self, now):
+        if not self.config['expire']:
+            return float('inf')
+        i_calc = self.config['i_calc']
+        return i_calc.from_bucket(i_calc.to_bucket(now, 1))
+
+    def buckets(self, timestamp):
+        '''(i_time, r_time, ttl) of a timestamp, r_time is -1 for coarse
+           intervals'''
+        if self._primed:
+            value = self._primed.get(timestamp)
+            if value is not None:
+                return value
+        if not self._relative:
+            return self._compute(timestamp)
+        memo = self._memo
+        if memo is not None and memo[0] <= timestamp < memo[1]:
+            if time.time() < memo[2]:
+                return memo[3]
+
+        now = time.time()
+        value = self._compute(timestamp)
+        i_calc, r_calc = self.config['i_calc'], self.config['r_calc']
+        first = i_calc.from_bucket(value[0])
+        last = i_calc.from_bucket(value[0] + 1)
+        if not self.config['coarse']:
+            first = max(first, r_calc.from_bucket(value[1]))
+            last = min(last, r_calc.from_bucket(value[1] + 1))
+        self._memo = (first, last, self._ttl_expires(now), value)
+        return value
+
+    def prime(self, timestamps):
+        '''Computes the buckets of many timestamps at once, the ttl once
+           per i_time, for buckets() to return until clear() is called.'''
+        if not self._relative:
+            self._primed = dict((t, self._compute(t)) for t in timestamps)
+            return
+        config = self.config
+        i_calc, r_calc = config['i_calc'], config['r_calc']
+        timestamps = list(timestamps)
+        i_times = [i_calc.to_bucket(t) for t in timestamps]
+        if config['coarse']:
+            r_times = [-1] * len(timestamps)
+        else:
+            r_times = [r_calc.to_bucket(t) for t in timestamps]
+        ttls = dict((i_time, config['ttl'](i_calc.from_bucket(i_time)))
+                    for i_time in set(i_times))
+        self._primed = dict(
+            (t, (i_time, r_time, ttls[i_time]))
+            for t, i_time, r_time in zip(timestamps, i_times, r_times))
+
+    def clear(self):
+        self._primed = {}
+
+
+def series_buckets(config, start=None, end=None, steps=None):
+    '''i_time buckets series() reads for a range, following the same
+       defaults as kairos'''
+    i_calc = config['i_calc']
+    steps = steps or config.get('steps', 1)
+    if end is None:
+        if start is None:
+            end = time.time()
+            end_bucket = i_calc.to_bucket(end)
+            start_bucket = i_calc.to_bucket(end, (-steps + 1))
+        else:
+            start_bucket = i_calc.to_bucket(start)
+            end_bucket = i_calc.to_bucket(start, steps - 1)
+    else:
+        end_bucket = i_calc.to_bucket(end)
+        if start is None:
+            start_bucket = i_calc.to_bucket(end, (-steps + 1))
+        else:
+            start_bucket = i_calc.to_bucket(start)
+    start = i_calc.from_bucket(start_bucket)
+    end = i_calc.from_bucket(end_bucket)
+    if start > end:
+        end = start
+    return i_calc.buckets(start, end)
+
+
+def parse_intervals(specs):
+    '''Intervals config from "name=step[:resolution]" strings'''
+    intervals = {}
+    for spec in specs:
+        interval, _, steps = spec.partition('=')
+        step, _, resolution = steps.partition(':')
+        intervals[interval] = {'step': step, 'resolution': resolution or step}
+    return intervals
+
+
+def histogram_percentile(histogram, percentile):
+    '''Nearest-rank percentile of a {value: count} histogram'''
+    total = sum(histogram.values())
+    if not total:
+        return 0
+    threshold = max(1, int(math.ceil(percentile / 100.0 * total)))
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if seen >= threshold:
+            return value
+    return value
+
+
+class LRUCache(object):
+    '''Bounded mapping that evicts the least recently used key'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def keys(self):
+        return list(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+
+class LRUSet(LRUCache):
+    '''Bounded set that forgets the least recently seen members'''
+
+    def __contains__(self, key):
+        return self.get(key, False)
+
+    def add(self, key):
+        self[key] = True
@@ -0,0 +1,88 @@
+'''Top names per bucket, counted by the writers'''
+
+import threading
+import time
+
+from .sketches import SpaceSaving
+
+
+class Leaderboard(object):
+    """Heaviest names of the current bucket of each interval, counted by
+       this writer in a SpaceSaving sketch of ``capacity`` names. Writes
+       to buckets older than the current one are not counted.
+
+       changes() returns the rows to write since the last ones applied,
+       at most every ``flush_interval`` seconds unless a bucket was
+       rotated.
+    """
+
+    def __init__(self, capacity=100, flush_interval=10):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        # interval: [i_time, ttl, sketch, counts written]
+        self._buckets = {}
+        self._retired = []
+        # Whether a bucket was retired since the last changes() call
+        self._rotated = False
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, interval, i_time, ttl, name, count=1):
+        with self._lock:
+            bucket = self._buckets.get(interval)
+            if bucket is None or i_time > bucket[0]:
+                if bucket is not None:
+                    self._retired.append((interval, bucket))
+                    self._rotated = True
+                bucket = [i_time, ttl, SpaceSaving(self.capacity), {}]
+                self._buckets[interval] = bucket
+            elif i_time < bucket[0]:
+                return
+            bucket[1] = ttl
+            bucket[2].add(name, count)
+
+    def due(self):
+        '''Whether changes() should be called'''
+        return self._rotated or (
+            time.time() - self._flushed_at >= self.flush_interval)
+
+    def changes(self):
+        '''[(interval, i_time, ttl, rows, evicted, applied)] of the buckets
+           changed since the last changes applied, rows being the (name,
+           count, error) to write and evicted the names no longer in the
+           sketch. applied() is called once they are written, so that
+           rows that failed to be written are returned again.'''
+        rval = []
+        with self._lock:
+            self._flushed_at = time.time()
+            self._rotated = False
+            buckets = self._retired + list(self._buckets.items())
+            for interval, bucket in buckets:
+                i_time, ttl, sketch, written = bucket
+                rows = [(name, count, error)
+                        for name, count, error in sketch.items()
+                        if written.get(name) != count]
+                evicted = [name for name in written if name not in sketch]
+                if rows or evicted:
+                    rval.append((interval, i_time, ttl, rows, evicted,
+                                 self._applied(bucket, rows, evicted)))
+                else:
+                    self._retire(bucket)
+        return rval
+
+    def _applied(self, bucket, rows, evicted):
+        def applied():
+            with self._lock:
+                written = bucket[3]
+                for name, count, _ in rows:
+                    written[name] = count
+                for name in evicted:
+                    written.pop(name, None)
+                self._retire(bucket)
+        return applied
+
+    def _retire(self, bucket):
+        '''Drops a retired bucket once written, called with _lock held'''
+        self._retired = [(interval, retired)
+                         for interval, retired in self._retired
+                         if retired is not bucket]
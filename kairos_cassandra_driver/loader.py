@@ -0,0 +1,348 @@
+'''
+Bulk loader of metric dumps into a series. Records are read from CSV
+(timestamp,name,value) or JSON lines ({"timestamp", "name", "value"})
+files, sharded by series name across worker processes, and written by
+each worker as batched, concurrent statements over its own session.
+
+Progress is checkpointed per chunk of input lines, so an interrupted
+load resumes after the last chunk that was fully written. Series
+appends and counters are not idempotent: a chunk that failed part way
+is written again on resume.
+'''
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from .helpers import parse_intervals
+from .sketches import hash64
+from .utils import string_types
+
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full
+
+FORMATS = ('csv', 'jsonl')
+# kairos value types of the series stored as ascii, text or blob
+TEXT_TYPES = set([str, type(u''), 'str', 'string', 'unicode', 'text',
+                  'clob', 'blob'])
+
+
+def _parse_value(value, value_type=None):
+    '''Value of a record for a series of value_type: numbers are parsed
+       unless the series stores text'''
+    if value_type in TEXT_TYPES:
+        if isinstance(value, string_types):
+            return value
+        return str(value)
+    if not isinstance(value, string_types):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def read_records(path, fmt=None, value_type=None):
+    """Yields (line, timestamp, name, value) for the records of a dump
+       :param fmt: 'csv' or 'jsonl', guessed from the extension by default
+       :param value_type: value type of the series, values are only
+                          parsed as numbers for numeric types
+       A CSV header line is skipped and a missing value reads as 1.
+    """
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s' % fmt)
+    with open(path) as f:
+        if fmt == 'csv':
+            reader = csv.reader(f)
+            for row in reader:
+                if not row:
+                    continue
+                try:
+                    timestamp = float(row[0])
+                except ValueError:
+                    continue
+                value = row[2] if len(row) > 2 and row[2] else 1
+                yield (reader.line_num, timestamp, row[1],
+                       _parse_value(value, value_type))
+        else:
+            for line, data in enumerate(f, 1):
+                if not data.strip():
+                    continue
+                record = json.loads(data)
+                yield (line, float(record['timestamp']), record['name'],
+                       _parse_value(record.get('value', 1), value_type))
+
+
+def _load_checkpoint(checkpoint, path):
+    '''Number of lines of path already loaded'''
+    try:
+        with open(checkpoint) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return 0
+    if data.get('path') != os.path.abspath(path):
+        return 0
+    return data.get('line', 0)
+
+
+def _save_checkpoint(checkpoint, path, line):
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'path': os.path.abspath(path), 'line': line}, f)
+    os.rename(tmp, checkpoint)
+
+
+def _write_records(series, session, records, batch_size, concurrency):
+    '''Writes (timestamp, name, value) records with batches of up to
+       batch_size statements of one series name, as all statements of a
+       name fall in the same partition. The batches of different names
+       run concurrently, and those of a name one after the other.'''
+    from cassandra.concurrent import execute_concurrent
+    from cassandra.query import BatchStatement, BatchType
+
+    batch_type = BatchType.COUNTER if series._counter else BatchType.UNLOGGED
+    by_name = {}
+    for timestamp, name, value in records:
+        if series._write_func:
+            value = series._write_func(value)
+        stmts = by_name.setdefault(name, OrderedDict())
+        for cell, stmt in series._insert_stmts(name, value, timestamp):
+            # Writes in a batch share its timestamp, and Cassandra keeps
+            # the largest of the values written to a cell at the same
+            # timestamp: only the last write of a cell is kept
+            if not series._overwrite:
+                cell = len(stmts)
+            stmts.pop(cell, None)
+            stmts[cell] = stmt
+
+    # Waves of the first batch of each name, then the second...
+    waves = []
+    for stmts in by_name.values():
+        stmts = list(stmts.values())
+        for n, i in enumerate(range(0, len(stmts), batch_size)):
+            batch = BatchStatement(
+                batch_type=batch_type,
+                consistency_level=series.write_consistency_level)
+            batch.is_idempotent = series._idempotent_insert
+            if series._idempotent_insert and series._retry_policy:
+                batch.retry_policy = series._retry_policy
+            for stmt in stmts[i:i + batch_size]:
+                batch.add(stmt)
+            if n == len(waves):
+                waves.append([])
+            waves[n].append((batch, ()))
+    for batches in waves:
+        execute_concurrent(session, batches, concurrency=concurrency,
+                           raise_on_first_error=True)
+    return len(records)
+
+
+def _worker(tasks, results, hosts, port, series_kwargs, batch_size,
+            concurrency):
+    '''Worker process: writes the records of the chunks it is sent over
+       its own cluster connection until it gets None.'''
+    from cassandra.cluster import Cluster
+    from .cassandra_timeseries import Timeseries
+
+    cluster = Cluster(hosts, port=port)
+    try:
+        try:
+            series = Timeseries(
+                cluster, **dict(series_kwargs, create_table=False))
+            session = series._get_session()
+        except Exception as e:
+            results.put((None, 0, repr(e)))
+            return
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            chunk, records = task
+            try:
+                count = _write_records(series, session, records, batch_size,
+                                       concurrency)
+                results.put((chunk, count, None))
+            except Exception as e:
+                results.put((chunk, 0, repr(e)))
+    finally:
+        cluster.shutdown()
+
+
+def _report(loaded, elapsed):
+    rate = loaded / elapsed if elapsed else 0
+    sys.stderr.write('%d records loaded, %.0f records/s\n' % (loaded, rate))
+
+
+def load(path, hosts, series_kwargs, fmt=None, port=9042, workers=None,
+         batch_size=50, concurrency=16, chunk_size=10000, queue_size=4,
+         checkpoint=None, progress=_report, progress_interval=5):
+    """Loads a dump into a series with a pool of worker processes
+       :param path: CSV or JSON lines file, see read_records
+       :param hosts: contact points of the cluster
+       :param series_kwargs: Timeseries arguments of the series, the
+                             table must already exist
+       :param workers: number of processes, one per CPU by default
+       :param batch_size: maximum statements per batch
+       :param concurrency: batches in flight per worker
+       :param chunk_size: input lines per checkpointed chunk
+       :param queue_size: chunks queued per worker before reading blocks
+       :param checkpoint: file recording the lines already loaded
+       :param progress: callable(records, seconds), called every
+                        progress_interval seconds and at the end
+       Returns the number of records loaded.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    skip = _load_checkpoint(checkpoint, path) if checkpoint else 0
+
+    results = multiprocessing.Queue()
+    queues, processes = [], []
+    for _ in range(workers):
+        tasks = multiprocessing.Queue(queue_size)
+        process = multiprocessing.Process(
+            target=_worker, args=(tasks, results, hosts, port, series_kwargs,
+                                  batch_size, concurrency))
+        process.daemon = True
+        process.start()
+        queues.append(tasks)
+        processes.append(process)
+
+    state = {'loaded': 0, 'done': 0, 'reported': time.time()}
+    pending = {}
+    ends = []
+    start = time.time()
+
+    def collect(block):
+        while pending:
+            try:
+                chunk, count, error = results.get(block, 1)
+            except Empty:
+                if not all(p.is_alive() for p in processes):
+                    raise RuntimeError('A loader worker exited')
+                if block:
+                    continue
+                return
+            block = False
+            if error is not None:
+                if chunk is None:
+                    raise RuntimeError('Worker failed to start: %s' % error)
+                raise RuntimeError('Chunk ending at line %d failed: %s' %
+                                   (ends[chunk], error))
+            state['loaded'] += count
+            pending[chunk] -= 1
+            if not pending[chunk]:
+                del pending[chunk]
+            # The checkpoint only moves past chunks that are all written
+            done = state['done']
+            while done < len(ends) and done not in pending:
+                done += 1
+            if done != state['done']:
+                state['done'] = done
+                if checkpoint:
+                    _save_checkpoint(checkpoint, path, ends[done - 1])
+            if progress and time.time() - state['reported'] >= progress_interval:
+                state['reported'] = time.time()
+                progress(state['loaded'], time.time() - start)
+
+    def dispatch(records, end):
+        chunk = len(ends)
+        ends.append(end)
+        shards = {}
+        for _, timestamp, name, value in records:
+            shards.setdefault(hash64(name) % workers, []).append(
+                (timestamp, name, value))
+        pending[chunk] = len(shards)
+        if not shards:
+            del pending[chunk]
+        for worker, shard in shards.items():
+            while True:
+                try:
+                    queues[worker].put((chunk, shard), True, 1)
+                    break
+                except Full:
+                    collect(False)
+                    if not processes[worker].is_alive():
+                        raise RuntimeError('A loader worker exited')
+        collect(False)
+
+    try:
+        records = []
+        for record in read_records(path, fmt,
+                                   series_kwargs.get('value_type')):
+            if record[0] <= skip:
+                continue
+            records.append(record)
+            if len(records) >= chunk_size:
+                dispatch(records, record[0])
+                records = []
+        if records:
+            dispatch(records, records[-1][0])
+        while pending:
+            collect(True)
+        for tasks in queues:
+            tasks.put(None)
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    if progress:
+        progress(state['loaded'], time.time() - start)
+    return state['loaded']
+
+
+def main(argv=None):
+    '''Command line entry point of the loader'''
+    parser = argparse.ArgumentParser(
+        description='Load CSV or JSON lines metric dumps into Cassandra')
+    parser.add_argument('path', help='file to load')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='input format, guessed from the extension')
+    parser.add_argument('--hosts', default='127.0.0.1',
+                        help='comma separated contact points')
+    parser.add_argument('--port', type=int, default=9042)
+    parser.add_argument('--keyspace', default='kairos')
+    parser.add_argument('--type', required=True,
+                        choices=['series', 'histogram', 'count', 'gauge',
+                                 'set'])
+    parser.add_argument('--table', help='table name, defaults to the type one')
+    parser.add_argument('--value-type', default='float')
+    parser.add_argument('--interval', action='append', required=True,
+                        help='name=step[:resolution], repeatable')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--checkpoint',
+                        help='file to resume from and record progress to')
+    args = parser.parse_args(argv)
+
+    series_kwargs = {'type': args.type,
+                     'intervals': parse_intervals(args.interval),
+                     'keyspace': args.keyspace,
+                     'value_type': args.value_type}
+    if args.table:
+        series_kwargs['table_name'] = args.table
+
+    count = load(args.path, args.hosts.split(','), series_kwargs,
+                 fmt=args.format, port=args.port, workers=args.workers,
+                 batch_size=args.batch_size, concurrency=args.concurrency,
+                 chunk_size=args.chunk_size, checkpoint=args.checkpoint)
+    sys.stdout.write('%d records loaded from %s\n' % (count, args.path))
+
+
+if __name__ == '__main__':
+    main()
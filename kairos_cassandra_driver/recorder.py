@@ -0,0 +1,152 @@
+'''Recording of an event into several series at once'''
+
+import time
+
+from cassandra.query import BatchStatement, BatchType
+
+from .cassandra_timeseries import SPOOL_ERRORS
+
+
+class Recorder(object):
+    """Fans an event out to several series, such as a count, a histogram
+       of its latency and a set of its users, over one session. The
+       counter updates of all the series go in one counter batch per
+       consistency level and the other writes are sent concurrently with
+       it, those of one series one after the other. A record costs about
+       one round trip per write of its largest series.
+
+       The series must be on the same cluster and keyspace. The session
+       is opened on the first record and kept until close(). Write
+       filters and spools apply as with insert(): a write that fails with
+       the cluster unavailable is spooled if its series has a spool.
+    """
+
+    def __init__(self, series):
+        '''series: dict of keys naming the series objects to record to'''
+        self.series = dict(series)
+        if not self.series:
+            raise ValueError('A recorder needs at least one series')
+        if len(set((id(s.cluster), s._keyspace)
+                   for s in self.series.values())) > 1:
+            raise ValueError('Recorded series must share a cluster and '
+                             'a keyspace')
+        self._lead = self.series[sorted(self.series)[0]]
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            for series in self.series.values():
+                series._setup_table()
+            self._session = self._lead._hold_session()
+        return self._session
+
+    def close(self):
+        '''Releases the session of the recorder'''
+        if self._session is not None:
+            self._session = None
+            self._lead._release_session()
+
+    def _statements(self, series, name, value, timestamp, intervals):
+        '''(stmt, applied) write statements of an insert into a series, in
+           order, see CassandraBackend._write'''
+        if not isinstance(value, (list, tuple, set)):
+            value = [value]
+        series._pending = []
+        try:
+            for v in value:
+                if series._write_func:
+                    v = series._write_func(v)
+                series._insert(name, v, timestamp, intervals)
+            return series._pending
+        finally:
+            series._pending = None
+
+    def record(self, name, values, timestamp=None, intervals=0):
+        """Inserts an event in several series
+           :param name: series name the event is recorded under
+           :param values: dict of series keys and the value to insert in
+                          each, series without a value are skipped
+           :param timestamp: as in insert(), now by default
+           :param intervals: as in insert()
+        """
+        unknown = set(values) - set(self.series)
+        if unknown:
+            raise ValueError('Unknown series %s' % ', '.join(sorted(unknown)))
+        timestamp = timestamp or time.time()
+
+        writes = []
+        counters = {}
+        for key in sorted(values):
+            series = self.series[key]
+            stmts = []
+            for stmt, applied in self._statements(series, name, values[key],
+                                                  timestamp, intervals):
+                if series._counter:
+                    counters.setdefault(series.write_consistency_level,
+                                        []).append((series, stmt, applied))
+                else:
+                    stmts.append((series, stmt, applied))
+            if stmts:
+                writes.append(stmts)
+        if not writes and not counters:
+            return
+
+        session = self._get_session()
+        futures = []
+        for level, stmts in counters.items():
+            batch = BatchStatement(batch_type=BatchType.COUNTER,
+                                   consistency_level=level)
+            for _, stmt, _ in stmts:
+                batch.add(stmt)
+            futures.append((stmts, session.execute_async(batch)))
+
+        # The other writes of a series run one after the other, so that
+        # list appends keep their order and gauges their last value: in
+        # waves of the next write of each series, sent with the counters
+        error = None
+        while futures or writes:
+            for stmts in writes:
+                series, stmt, applied = stmts.pop(0)
+                if series._spooling:
+                    # An earlier write was spooled, replay keeps the order
+                    series._spool_write(stmt, name, applied)
+                    continue
+                query = series._statement(stmt, series._idempotent_insert,
+                                          series.write_consistency_level)
+                futures.append(([(series, stmt, applied)],
+                                session.execute_async(query)))
+            failed, wave_error = self._wait(name, futures)
+            error = error or wave_error
+            futures = []
+            # Like insert(), a series stops at its first failed write
+            writes = [stmts for stmts in writes
+                      if stmts and stmts[0][0] not in failed]
+        if error is not None:
+            raise error
+
+    def _wait(self, name, futures):
+        """Waits for (stmts, future) pairs of writes of name. Returns the
+           series of the writes that failed and were not spooled, and the
+           first error."""
+        # The write filters only learn of the writes that were applied or
+        # spooled, so that failed ones aren't skipped when retried
+        failed, error = [], None
+        for stmts, future in futures:
+            try:
+                future.result()
+            except SPOOL_ERRORS as e:
+                for series, stmt, applied in stmts:
+                    if not series._spoolable(e):
+                        failed.append(series)
+                        error = error or e
+                        continue
+                    series._spooling = True
+                    series._spool_write(stmt, name, applied)
+            except Exception as e:
+                failed.extend(series for series, _, _ in stmts)
+                error = error or e
+            else:
+                for _, _, applied in stmts:
+                    if applied:
+                        applied()
+        return failed, error
@@ -0,0 +1,38 @@
+'''Registration of the cassandra backend in kairos'''
+
+import sys
+
+
+class ContactPoints(list):
+    """Hosts of a string client, see CassandraBackend.url_parse. kairos
+       picks the backend of a client by the package of its class, which
+       is registered along with 'cassandra'.
+    """
+
+
+class CassandraBackendEntry(object):
+    """Entry of CassandraBackend in the kairos backends. kairos initialises
+       the series returned by the backend of a client, so this entry only
+       creates it, importing the backend module on first use.
+    """
+
+    def __new__(cls, client, **kwargs):
+        from .cassandra_timeseries import CassandraBackend
+        return CassandraBackend.__new__(CassandraBackend, client, **kwargs)
+
+    @classmethod
+    def url_parse(cls, url, **kwargs):
+        from .cassandra_timeseries import CassandraBackend
+        return CassandraBackend.url_parse(url, **kwargs)
+
+
+def register(backends=None):
+    '''Adds the entry to backends. By default to the kairos backends, if
+       kairos was imported, since importing it is slow.'''
+    if backends is None:
+        timeseries = sys.modules.get('kairos.timeseries')
+        backends = getattr(timeseries, 'BACKENDS', None)
+        if backends is None:
+            return
+    backends['cassandra'] = CassandraBackendEntry
+    backends[ContactPoints.__module__.split('.')[0]] = CassandraBackendEntry
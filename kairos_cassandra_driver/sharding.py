@@ -0,0 +1,410 @@
+'''Series sharded by name across several clusters or keyspaces'''
+
+import bisect
+import copy
+import fnmatch
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from kairos.exceptions import UnknownInterval
+
+from .cassandra_timeseries import Timeseries
+from .helpers import series_buckets
+from .sketches import hash64
+from .utils import string_types
+
+
+class ConsistentHashRing(object):
+    """Maps keys to nodes by consistent hashing, with ``replicas`` points
+       per node so that adding a node to n moves about 1/(n+1) of the keys.
+    """
+
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            raise ValueError('%s is already in the ring' % node)
+        self.nodes.append(node)
+        points = list(zip(self._points, self._owners))
+        points.extend((hash64('%s:%d' % (node, i)), node)
+                      for i in range(self.replicas))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._owners = [owner for _, owner in points]
+
+    def node(self, key):
+        '''Node owning a key'''
+        if not self._points:
+            raise ValueError('The ring is empty')
+        i = bisect.bisect(self._points, hash64(key)) % len(self._points)
+        return self._owners[i]
+
+
+def _fan_out(func, args):
+    '''Calls func(*arg) for each of args in its own thread. Returns the
+       results in order, or raises the first error.'''
+    if len(args) == 1:
+        return [func(*args[0])]
+    results = [None] * len(args)
+    errors = []
+
+    def run(i, arg):
+        try:
+            results[i] = func(*arg)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i, arg))
+               for i, arg in enumerate(args)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class ShardedTimeseries(object):
+    """Series of one type spread over several clusters or keyspaces. Each
+       name lives on one shard, picked by consistent hashing of the name
+       over the shard names. Reads of several names, list() and
+       aggregate() query the shards in parallel.
+
+       add_shard() starts a background rebalance that moves the names the
+       new shard takes over one at a time: a name is read from and
+       written to its old shard until it has been copied, writes to it
+       wait during its copy, and it is then deleted from the old shard.
+       Only the writes made through this instance are coordinated, other
+       writers should be stopped or use the same shards while it runs.
+       The rebalance reads and writes through series of its own, so it
+       doesn't share sessions with the other threads. A rebalance stopped
+       by an error is continued with resume_rebalance().
+    """
+
+    def __init__(self, shards, **kwargs):
+        '''shards: dict of shard names and (cluster, keyspace) targets, a
+           keyspace of None standing for the 'keyspace' argument. Shard
+           names place the series on the ring and must not change.
+           Other arguments are those of Timeseries, for every shard.'''
+        if not shards:
+            raise ValueError('At least one shard is needed')
+        self._kwargs = kwargs
+        self._targets = dict(shards)
+        self.shards = OrderedDict()
+        for shard in sorted(shards):
+            self.shards[shard] = self._backend(*shards[shard])
+        self._ring = ConsistentHashRing(self.shards)
+        # Ring before add_shard, while the rebalance runs
+        self._old_ring = None
+        self._moved = set()
+        self._touched = set()
+        # Moved names still to delete from their old shard
+        self._leftover = set()
+        self._copying = set()
+        self._active = Counter()
+        self._held = set()
+        self._cond = threading.Condition()
+        self._rebalancer = None
+        self.rebalance_error = None
+
+    def _backend(self, cluster, keyspace=None):
+        kwargs = dict(self._kwargs)
+        # kairos keeps its state in the intervals configuration
+        kwargs['intervals'] = copy.deepcopy(kwargs.get('intervals', {}))
+        if keyspace:
+            kwargs['keyspace'] = keyspace
+        return Timeseries(cluster, **kwargs)
+
+    @property
+    def _lead(self):
+        return self.shards[self._ring.nodes[0]]
+
+    def _session(self, shard):
+        '''Session of a shard, held until close()'''
+        with self._cond:
+            if shard not in self._held:
+                self._held.add(shard)
+                return self.shards[shard]._hold_session()
+        return self.shards[shard]._get_session()
+
+    def _owner(self, name):
+        '''Shard of a name, called with _cond held'''
+        shard = self._ring.node(name)
+        if self._old_ring is not None and name not in self._moved:
+            return self._old_ring.node(name)
+        return shard
+
+    @contextmanager
+    def _routed(self, names, write=False):
+        '''Marks operations on names in flight and yields {shard: names}.
+           Writes wait for the copy of the names being moved.'''
+        with self._cond:
+            while write and self._copying.intersection(names):
+                self._cond.wait()
+            groups = OrderedDict()
+            for name in names:
+                shard = self._owner(name)
+                if write and shard != self._ring.node(name):
+                    self._touched.add(name)
+                groups.setdefault(shard, []).append(name)
+                self._active[name] += 1
+        try:
+            yield groups
+        finally:
+            with self._cond:
+                for name in names:
+                    self._active[name] -= 1
+                    if not self._active[name]:
+                        del self._active[name]
+                self._cond.notify_all()
+
+    def shard(self, name):
+        '''Name of the shard a series is on'''
+        with self._cond:
+            return self._owner(name)
+
+    def insert(self, name, *args, **kwargs):
+        '''Inserts in the shard of name, see Timeseries.insert'''
+        with self._routed([name], write=True) as groups:
+            shard, = groups
+            self._session(shard)
+            self.shards[shard].insert(name, *args, **kwargs)
+
+    def delete(self, name):
+        with self._routed([name], write=True) as groups:
+            shard, = groups
+            self.shards[shard].delete(name)
+
+    def list(self):
+        '''Names of all the shards'''
+        def read(shard):
+            self._session(shard)
+            return self.shards[shard].list()
+
+        names = set()
+        for shard_names in _fan_out(read, [(s,) for s in self.shards]):
+            names.update(shard_names)
+        return sorted(names)
+
+    def _scatter(self, names, interval, buckets, concurrency, join_rows):
+        '''Rows of the buckets of names, read from their shards in parallel
+           and joined per bucket, see CassandraBackend._aggregate_rows'''
+        with self._routed(names) as groups:
+            def read(shard, shard_names):
+                return self.shards[shard]._aggregate_rows(
+                    self._session(shard), shard_names, interval, buckets,
+                    concurrency, join_rows)
+            results = _fan_out(read, list(groups.items()))
+
+        cells = {}
+        for data in results:
+            for i_bucket, i_data in data.items():
+                for r_bucket, row in i_data.items():
+                    cells.setdefault((i_bucket, r_bucket), []).append(row)
+        rval = OrderedDict()
+        for key in sorted(cells):
+            rval.setdefault(key[0], OrderedDict())[key[1]] = join_rows(
+                cells[key])
+        return rval
+
+    def _config(self, interval):
+        config = self._lead._intervals.get(interval)
+        if not config:
+            raise UnknownInterval(interval)
+        return config
+
+    def _names(self, names):
+        if isinstance(names, string_types):
+            return [name for name in self.list()
+                    if fnmatch.fnmatchcase(name, names)]
+        return list(names)
+
+    def get(self, name, interval, concurrency=16, **kwargs):
+        '''Timeseries.get, names of a list being read from their shards
+           in parallel'''
+        if not isinstance(name, (list, tuple, set)):
+            with self._routed([name]) as groups:
+                shard, = groups
+                self._session(shard)
+                return self.shards[shard].get(name, interval, **kwargs)
+
+        config = self._config(interval)
+        kwargs['timestamp'] = kwargs.get('timestamp') or time.time()
+        buckets = [config['i_calc'].to_bucket(kwargs['timestamp'])]
+        join_rows = kwargs.pop('join_rows', None) or self._lead._join
+        data = self._scatter(list(name), interval, buckets, concurrency,
+                             join_rows)
+
+        def fetch(session, table, name, interval, buckets):
+            return data
+
+        self._session(self._ring.nodes[0])
+        return self._lead.get(None, interval, fetch=fetch, **kwargs)
+
+    def series(self, name, interval, concurrency=16, **kwargs):
+        '''Timeseries.series, names of a list being read from their shards
+           in parallel'''
+        if not isinstance(name, (list, tuple, set)):
+            with self._routed([name]) as groups:
+                shard, = groups
+                self._session(shard)
+                return self.shards[shard].series(name, interval, **kwargs)
+        kwargs.setdefault('join_rows', self._lead._join)
+        return self.aggregate(list(name), interval, concurrency, **kwargs)
+
+    def aggregate(self, names, interval, concurrency=16, **kwargs):
+        '''CassandraBackend.aggregate over all the shards, each reading its
+           names in parallel'''
+        pattern = names if isinstance(names, string_types) else None
+        names = self._names(names)
+        config = self._config(interval)
+        buckets = series_buckets(config, kwargs.get('start'),
+                                 kwargs.get('end'), kwargs.get('steps'))
+        join_rows = kwargs.pop('join_rows', None) or self._lead._join_names
+        data = self._scatter(names, interval, buckets, concurrency,
+                             join_rows)
+
+        def fetch(session, table, name, interval, buckets):
+            return data
+
+        self._session(self._ring.nodes[0])
+        return self._lead.series(pattern, interval, fetch=fetch, **kwargs)
+
+    def add_shard(self, shard, cluster, keyspace=None, progress=None):
+        """Adds a shard and moves the names it takes over in a background
+           thread, which is returned
+           :param progress: callable(name) called as each name is moved
+           Errors stop the rebalance and are kept in rebalance_error, the
+           names not moved yet staying on their old shard until
+           resume_rebalance() is called.
+        """
+        with self._cond:
+            if self.rebalance_error is not None:
+                raise ValueError('A rebalance stopped by an error must be '
+                                 'resumed first')
+            if self._old_ring is not None:
+                raise ValueError('A rebalance is already running')
+            if shard in self.shards:
+                raise ValueError('%s is already a shard' % shard)
+            ring = ConsistentHashRing(self._ring.nodes, self._ring.replicas)
+            ring.add(shard)
+            self._targets[shard] = (cluster, keyspace)
+            self.shards[shard] = self._backend(cluster, keyspace)
+            self._old_ring, self._ring = self._ring, ring
+            self._moved.clear()
+            self._touched.clear()
+            self.rebalance_error = None
+            return self._start_rebalance(progress)
+
+    def resume_rebalance(self, progress=None):
+        """Continues a rebalance stopped by an error in a background
+           thread, which is returned
+           :param progress: callable(name) called as each name is moved
+        """
+        with self._cond:
+            if self._old_ring is None:
+                raise ValueError('No rebalance to resume')
+            if self._rebalancer.is_alive():
+                raise ValueError('A rebalance is already running')
+            self.rebalance_error = None
+            return self._start_rebalance(progress)
+
+    def _start_rebalance(self, progress):
+        '''Starts the rebalance thread, called with _cond held'''
+        self._rebalancer = threading.Thread(target=self._rebalance,
+                                            args=(progress,))
+        self._rebalancer.daemon = True
+        self._rebalancer.start()
+        return self._rebalancer
+
+    def _moving(self, names):
+        '''Names still to move, called with _cond held'''
+        return sorted(name for name in names if name not in self._moved and
+                      self._old_ring.node(name) != self._ring.node(name))
+
+    def _rebalance(self, progress):
+        # Series of the rebalance, whose sessions are its own
+        movers = {}
+        try:
+            for shard in self._ring.nodes:
+                movers[shard] = self._backend(*self._targets[shard])
+                movers[shard]._hold_session()
+            for name in sorted(self._leftover):
+                movers[self._old_ring.node(name)].delete(name)
+                self._leftover.discard(name)
+            while True:
+                names = set()
+                for shard in self._old_ring.nodes:
+                    names.update(movers[shard].list())
+                with self._cond:
+                    moving = self._moving(names | self._touched)
+                    if not moving:
+                        # Writes routed to the old shards since the last
+                        # listing were all to names already moved
+                        self._old_ring = None
+                        self._moved.clear()
+                        self._touched.clear()
+                        return
+                for name in moving:
+                    self._move(movers, name)
+                    if progress:
+                        progress(name)
+        except Exception as e:
+            self.rebalance_error = e
+        finally:
+            for mover in movers.values():
+                mover.close()
+
+    def _move(self, movers, name):
+        '''Copies a name to its new shard, routes it there and deletes it
+           from the old one'''
+        with self._cond:
+            self._copying.add(name)
+            while self._active[name]:
+                self._cond.wait()
+            source = movers[self._old_ring.node(name)]
+            target = movers[self._ring.node(name)]
+        try:
+            # Left over by a copy that failed
+            target.delete(name)
+            for interval in source._intervals:
+                data = source._type_get(name, interval, -2 ** 63,
+                                        2 ** 63 - 1)
+                for stmt in target._copy_stmts(name, interval, data):
+                    target._execute(target._statement(
+                        stmt, target._idempotent_insert,
+                        target.write_consistency_level))
+            with self._cond:
+                self._moved.add(name)
+                self._leftover.add(name)
+        finally:
+            with self._cond:
+                self._copying.discard(name)
+                self._cond.notify_all()
+
+        with self._cond:
+            while self._active[name]:
+                self._cond.wait()
+        source.delete(name)
+        self._leftover.discard(name)
+
+    def close(self):
+        '''Waits for a running rebalance and closes the series of every
+           shard'''
+        if self._rebalancer is not None:
+            self._rebalancer.join()
+        with self._cond:
+            held, self._held = self._held, set()
+        for shard in held:
+            self.shards[shard]._release_session()
+        for backend in self.shards.values():
+            backend.close()
@@ -0,0 +1,256 @@
+'''Compact mergeable summaries used by the sketch storage modes'''
+
+import hashlib
+import heapq
+import math
+import struct
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, text_type):
+        value = text_type(value)
+    return value.encode('utf-8')
+
+
+def hash64(value):
+    '''Stable 64 bit hash of a value, identical across processes'''
+    digest = hashlib.sha1(_to_bytes(value)).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+
+class HyperLogLog(object):
+    """Cardinality estimator with 2**precision one byte registers.
+       Two sketches with the same precision merge by taking the
+       register-wise maximum, so partial sketches written by several
+       clients can be combined on read.
+    """
+
+    DENSE = 0
+    SPARSE = 1
+
+    def __init__(self, precision=12, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self._m = 1 << precision
+        if registers is None:
+            registers = bytearray(self._m)
+        self.registers = bytearray(registers)
+
+    def add(self, value):
+        '''Adds a value, returns True if the sketch changed'''
+        x = hash64(value)
+        width = 64 - self.precision
+        index = x >> width
+        rank = width - (x & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        '''Merges other sketch into this one in place'''
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def copy(self):
+        return HyperLogLog(self.precision, self.registers)
+
+    def cardinality(self):
+        m = self._m
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\0')
+        if zeros and estimate <= 2.5 * m:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.cardinality()
+
+    def __nonzero__(self):
+        return any(self.registers)
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        return (isinstance(other, HyperLogLog) and
+                self.precision == other.precision and
+                self.registers == other.registers)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<HyperLogLog p=%d ~%d>' % (self.precision, self.cardinality())
+
+    def to_bytes(self):
+        '''Serializes the sketch, sparse when few registers are set'''
+        used = [(i, r) for i, r in enumerate(self.registers) if r]
+        if len(used) * 3 < self._m:
+            body = b''.join(struct.pack('>HB', i, r) for i, r in used)
+            return struct.pack('>BB', self.SPARSE, self.precision) + body
+        return (struct.pack('>BB', self.DENSE, self.precision) +
+                bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytearray(data)
+        kind, precision = data[0], data[1]
+        if kind == cls.DENSE:
+            return cls(precision, data[2:])
+        sketch = cls(precision)
+        for offset in range(2, len(data), 3):
+            index, rank = struct.unpack('>HB', bytes(data[offset:offset + 3]))
+            sketch.registers[index] = rank
+        return sketch
+
+
+class LogBins(object):
+    """Maps non-negative values to logarithmically spaced bins so that the
+       bin's representative value is within ``relative_accuracy`` of every
+       value it holds (the DDSketch mapping). Counting per bin keeps a
+       histogram of a continuous metric to a bounded number of rows, and
+       bins of the same mapping merge by adding counts.
+    """
+
+    ZERO = -(2 ** 31)
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+
+    def key(self, value):
+        '''Bin key of a value'''
+        if value < 0:
+            raise ValueError('Only non-negative values can be binned')
+        if value < self.min_value:
+            return self.ZERO
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def value(self, key):
+        '''Representative value of a bin'''
+        if key == self.ZERO:
+            return 0.0
+        return 2.0 * self.gamma ** key / (self.gamma + 1)
+
+
+class BloomFilter(object):
+    """Fixed size probabilistic set sized for ``capacity`` members at a
+       false positive rate of ``error_rate``. Members are never reported
+       missing once added, but unseen values may be reported present.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.count = 0
+        bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             (math.log(2) ** 2)))
+        self.size = max(8, bits)
+        self.hashes = max(1, int(round(float(self.size) / capacity *
+                                       math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, value):
+        x = hash64(value)
+        h1, h2 = x & 0xffffffff, (x >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        self.count += 1
+        for index in self._indexes(value):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def full(self):
+        '''Whether capacity values were added, past which the false
+           positive rate exceeds error_rate'''
+        return self.count >= self.capacity
+
+    def __contains__(self, value):
+        for index in self._indexes(value):
+            if not self.bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+class SpaceSaving(object):
+    """Heavy hitters of a stream in ``capacity`` counters (Metwally et
+       al.). A key that is not tracked takes over the smallest counter
+       and inherits its count as its error, so counts are overestimated
+       by at most that error and any key seen more than total/capacity
+       times is tracked.
+    """
+
+    def __init__(self, capacity=1000):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        # Min-heap of (count, key), with stale entries skipped lazily
+        self._heap = []
+
+    def add(self, key, count=1):
+        self.total += count
+        if key in self._counts:
+            self._counts[key] += count
+        elif len(self._counts) < self.capacity:
+            self._counts[key] = count
+            self._errors[key] = 0
+        else:
+            while True:
+                smallest, victim = heapq.heappop(self._heap)
+                if self._counts.get(victim) == smallest:
+                    break
+            del self._counts[victim]
+            del self._errors[victim]
+            self._counts[key] = smallest + count
+            self._errors[key] = smallest
+        heapq.heappush(self._heap, (self._counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, k) for k, c in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def count(self, key):
+        '''Estimated count of a key, 0 if not tracked'''
+        return self._counts.get(key, 0)
+
+    def items(self):
+        '''(key, count, error) of the tracked keys'''
+        return [(k, c, self._errors[k]) for k, c in self._counts.items()]
+
+    def top(self, n=10):
+        '''(key, count, error) of the n keys with the highest counts'''
+        return heapq.nlargest(n, self.items(), key=lambda item: item[1])
+
+    def clear(self):
+        self.total = 0
+        self._counts.clear()
+        self._errors.clear()
+        self._heap = []
@@ -0,0 +1,254 @@
+'''
+Local write-ahead spool of mutations. Lets a series keep accepting
+writes at local disk speed while the cluster is slow or unreachable,
+and replays them in order once it is back.
+'''
+
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import SimpleStatement
+
+HEADER = struct.Struct('>II')
+
+
+class Spool(object):
+    """Append-only log of CQL mutations split in segment files bounded by
+       ``segment_size`` bytes and ``segment_age`` seconds. Records are
+       length prefixed and checksummed so a torn record left by a crash
+       is ignored. The replay position is kept in a checkpoint file next
+       to the segments.
+       :param path: directory of the spool, created if missing
+       :param segment_size: maximum size in bytes of a segment
+       :param segment_age: maximum age in seconds of the segment written to
+       :param fsync: whether to fsync every append
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024,
+                 segment_age=300, fsync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.fsync = fsync
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.RLock()
+        self._file = None
+        self._opened = None
+        self.checkpoint = self._load_checkpoint()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%020d.seg' % segment)
+
+    def _checkpoint_path(self):
+        return os.path.join(self.path, 'checkpoint.json')
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'segment': 0, 'offset': 0, 'done': []}
+
+    def save_checkpoint(self, segment, offset, done=()):
+        '''Records that everything before offset in segment was replayed,
+           as well as the records starting at the offsets in done.'''
+        with self._lock:
+            self.checkpoint = {'segment': segment, 'offset': offset,
+                               'done': sorted(done)}
+            tmp = self._checkpoint_path() + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.checkpoint, f)
+            os.rename(tmp, self._checkpoint_path())
+
+    def segments(self):
+        '''Ids of the segments on disk, oldest first'''
+        return sorted(int(f[:-4]) for f in os.listdir(self.path)
+                      if f.endswith('.seg'))
+
+    def _roll(self):
+        if self._file is not None:
+            self._file.close()
+        segments = self.segments()
+        segment = int(time.time() * 1000)
+        if segments:
+            segment = max(segment, segments[-1] + 1)
+        self._file = open(self._segment_path(segment), 'ab')
+        self._opened = time.time()
+
+    def append(self, query, consistency_level=None, idempotent=False,
+               key=None):
+        '''Appends a mutation to the spool. Mutations of the same key,
+           such as a series name, are replayed in order.'''
+        record = json.dumps([query, consistency_level, idempotent, key])
+        record = record.encode('utf-8')
+        data = HEADER.pack(len(record), zlib.crc32(record) & 0xffffffff)
+        with self._lock:
+            if (self._file is None or
+                    self._file.tell() + len(data) > self.segment_size or
+                    time.time() - self._opened > self.segment_age):
+                self._roll()
+            self._file.write(data + record)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def read(self, segment, offset=0):
+        '''Yields (offset, end, query, consistency_level, idempotent, key)
+           for the records of a segment, starting at offset.'''
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, crc = HEADER.unpack(header)
+                record = f.read(length)
+                if (len(record) < length or
+                        zlib.crc32(record) & 0xffffffff != crc):
+                    return
+                end = offset + HEADER.size + length
+                record = json.loads(record.decode('utf-8'))
+                # Records spooled without a key share one
+                key = record[3] if len(record) > 3 else None
+                yield (offset, end) + tuple(record[:3]) + (key,)
+                offset = end
+
+    def remove(self, segment):
+        '''Deletes a fully replayed segment'''
+        with self._lock:
+            os.remove(self._segment_path(segment))
+
+    def lag(self):
+        '''Replay lag: number of segments and bytes left to replay and
+           age in seconds of the oldest of those segments.'''
+        with self._lock:
+            segments = [s for s in self.segments()
+                        if s >= self.checkpoint['segment']]
+            pending = sum(os.path.getsize(self._segment_path(s))
+                          for s in segments)
+            if segments and segments[0] == self.checkpoint['segment']:
+                pending -= self.checkpoint['offset']
+            age = time.time() - segments[0] / 1000.0 if pending else 0
+        return {'segments': len(segments), 'bytes': pending, 'age': age}
+
+    def empty(self):
+        return not self.lag()['bytes']
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class SpoolReplayer(object):
+    """Drains a spool into Cassandra in batches of concurrent statements,
+       checkpointing after each batch. On failure the checkpoint is left
+       on the first failed record; non-idempotent records of the batch
+       that did succeed are remembered so they are not applied twice.
+       Records of different keys run concurrently and those of a key one
+       after the other, so gauges keep their last value and appends to a
+       series their order. The session must be connected to the keyspace
+       of the series.
+       ``retry_policy`` applies to the idempotent records.
+    """
+
+    def __init__(self, spool, session, batch_size=500, concurrency=50,
+                 retry_policy=None):
+        self.spool = spool
+        self.session = session
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy
+        self.replayed = 0
+        self.last_error = None
+
+    def _execute(self, batch):
+        '''Runs a batch of records in waves of the first record of each
+           key, then the second, and so on, stopping after a failed wave.
+           Returns the (success, result) of the records, those not run
+           being failed with a None result.'''
+        waves, counts = [], {}
+        for i, record in enumerate(batch):
+            n = counts.get(record[5], 0)
+            counts[record[5]] = n + 1
+            if n == len(waves):
+                waves.append([])
+            waves[n].append(i)
+
+        results = [(False, None)] * len(batch)
+        for wave in waves:
+            statements = [
+                (SimpleStatement(
+                    query, consistency_level=cl, is_idempotent=idempotent,
+                    retry_policy=self.retry_policy if idempotent else None),
+                 ())
+                for _, _, query, cl, idempotent, _ in (batch[i]
+                                                       for i in wave)]
+            wave_results = execute_concurrent(self.session, statements,
+                                              concurrency=self.concurrency,
+                                              raise_on_first_error=False)
+            for i, result in zip(wave, wave_results):
+                results[i] = tuple(result)
+            if not all(success for success, _ in wave_results):
+                break
+        return results
+
+    def replay(self):
+        '''Replays pending records in order until the spool is drained
+           or a statement fails. Returns the number of records replayed.'''
+        replayed = 0
+        while True:
+            checkpoint = self.spool.checkpoint
+            segments = [s for s in self.spool.segments()
+                        if s >= checkpoint['segment']]
+            if not segments:
+                return replayed
+            segment = segments[0]
+            offset, done = 0, set()
+            if segment == checkpoint['segment']:
+                offset, done = checkpoint['offset'], set(checkpoint['done'])
+
+            batch, end = [], offset
+            for record in self.spool.read(segment, offset):
+                end = record[1]
+                if record[0] not in done:
+                    batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+
+            if batch:
+                results = self._execute(batch)
+                failed = [i for i, (success, _) in enumerate(results)
+                          if not success]
+                if failed:
+                    first = failed[0]
+                    # Records after a failed wave weren't run
+                    self.last_error = [
+                        error for success, error in results
+                        if not success and error is not None][0]
+                    done = set(o for o in done if o > batch[first][0])
+                    done.update(batch[i][0]
+                                for i in range(first + 1, len(batch))
+                                if results[i][0] and not batch[i][4])
+                    self.spool.save_checkpoint(segment, batch[first][0], done)
+                    replayed += first
+                    self.replayed += first
+                    return replayed
+                replayed += len(batch)
+                self.replayed += len(batch)
+
+            if end != offset:
+                self.spool.save_checkpoint(segment, end)
+            elif len(segments) > 1:
+                # Only the newest segment can still be appended to
+                self.spool.remove(segment)
+                self.spool.save_checkpoint(segments[1], 0)
+            else:
+                return replayed
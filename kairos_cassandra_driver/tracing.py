@@ -0,0 +1,140 @@
+'''Sampled query tracing and hot series detection'''
+
+import collections
+import random
+import threading
+
+from .sketches import SpaceSaving
+
+
+class QuerySampler(object):
+    """Traces a fraction ``rate`` of the statements and keeps the last
+       ``history`` of them. Traces are only fetched from system_traces
+       when read with traces(), not on the request path.
+    """
+
+    def __init__(self, rate, history=100):
+        if not 0 <= rate <= 1:
+            raise ValueError('rate must be between 0 and 1')
+        self.rate = rate
+        self._pending = collections.deque(maxlen=history)
+        self._traces = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        '''Whether to trace the next statement'''
+        return self.rate > 0 and random.random() < self.rate
+
+    def add(self, stmt, name, future):
+        with self._lock:
+            self._pending.append((getattr(stmt, 'query_string', 'BATCH'),
+                                  name, future))
+
+    def _resolve(self, query, name, future, max_wait):
+        trace = future.get_query_trace(max_wait)
+        replicas = {}
+        for event in trace.events or ():
+            elapsed = event.source_elapsed
+            if elapsed is None:
+                continue
+            elapsed = elapsed.total_seconds()
+            source = str(event.source)
+            replicas[source] = max(replicas.get(source, 0), elapsed)
+        return {
+            'query': ' '.join(query.split()),
+            'name': name,
+            'coordinator': str(trace.coordinator),
+            'started_at': trace.started_at,
+            'duration': (trace.duration.total_seconds()
+                         if trace.duration is not None else None),
+            'replicas': replicas,
+        }
+
+    def traces(self, max_wait=2.0):
+        '''Sampled traces, oldest first, as dicts with the query, series
+           name, coordinator, duration in seconds and the time in seconds
+           spent on each replica. Traces that can't be fetched are
+           dropped.'''
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        for query, name, future in pending:
+            try:
+                trace = self._resolve(query, name, future, max_wait)
+            except Exception:
+                continue
+            with self._lock:
+                self._traces.append(trace)
+        with self._lock:
+            return list(self._traces)
+
+
+class HotNames(object):
+    """Requests and rows read per (table, name), kept for the heaviest
+       ``capacity`` series with SpaceSaving sketches.
+    """
+
+    def __init__(self, capacity=1000):
+        self.requests = SpaceSaving(capacity)
+        self.rows = SpaceSaving(capacity)
+        self._lock = threading.Lock()
+
+    def record(self, table, name, rows=0):
+        key = (table, name)
+        with self._lock:
+            self.requests.add(key)
+            if rows:
+                self.rows.add(key, rows)
+
+    def record_rows(self, table, name, rows):
+        if rows:
+            with self._lock:
+                self.rows.add((table, name), rows)
+
+    def counted(self, table, name, result):
+        '''Records a request and wraps its result so the rows are counted
+           as they are read, pages being fetched as usual.'''
+        self.record(table, name)
+        return CountedResult(self, table, name, result)
+
+    def top(self, n=10, by='requests'):
+        '''The n hottest series by 'requests' or 'rows', as dicts with
+           table, name, requests and rows. Counts are upper bounds, over
+           by at most 'error' for the metric sorted on.'''
+        if by not in ('requests', 'rows'):
+            raise ValueError("by must be 'requests' or 'rows'")
+        with self._lock:
+            rval = []
+            for key, _, error in getattr(self, by).top(n):
+                rval.append({
+                    'table': key[0],
+                    'name': key[1],
+                    'requests': self.requests.count(key),
+                    'rows': self.rows.count(key),
+                    'error': error,
+                })
+        return rval
+
+
+class CountedResult(object):
+    """Result of a request counting its rows in a HotNames as they are
+       iterated on. Other attributes are those of the wrapped result.
+    """
+
+    def __init__(self, hot_names, table, name, result):
+        self._hot_names = hot_names
+        self._table = table
+        self._name = name
+        self._result = result
+
+    def __iter__(self):
+        rows = 0
+        try:
+            for row in self._result:
+                rows += 1
+                yield row
+        finally:
+            self._hot_names.record_rows(self._table, self._name, rows)
+
+    def __getattr__(self, attr):
+        return getattr(self._result, attr)
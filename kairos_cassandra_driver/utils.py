@@ -1,3 +1,78 @@
+import math
+import numbers
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Approximate length in seconds of kairos' gregorian steps
+GREGORIAN_STEPS = {
+    'daily': 86400,
+    'weekly': 7 * 86400,
+    'monthly': 30 * 86400,
+    'yearly': 365 * 86400,
+}
+
+
+def create_cluster(contact_points, port=9042, local_dc='',
+                   protocol_version=None, compression=True,
+                   connections_per_host=None, request_timeout=10.0,
+                   connect_timeout=5, executor_threads=2, **kwargs):
+    """Creates a Cluster tuned for time series traffic: token aware
+       routing over DC aware round robin, so writes go straight to a
+       replica of the partition, and compressed frames.
+       :param contact_points: list of hosts, or a comma separated string
+       :param local_dc: name of the local datacenter, the one of the
+                        first contact point by default
+       :param protocol_version: native protocol version, negotiated by
+                                default
+       :param compression: 'lz4', 'snappy' or False, the default True
+                           picks lz4 when the lz4 package is installed
+       :param connections_per_host: connections to each local host, or a
+                                    (core, max) pair. Only protocol
+                                    versions 1 and 2 pool connections.
+       :param request_timeout: default timeout in seconds of a request
+       :param connect_timeout: timeout in seconds of opening a connection
+       :param executor_threads: threads handling the driver's callbacks
+       Other keyword arguments are passed to Cluster.
+    """
+    from cassandra.cluster import (Cluster, ExecutionProfile,
+                                   EXEC_PROFILE_DEFAULT)
+    from cassandra.connection import locally_supported_compressions
+    from cassandra.policies import (DCAwareRoundRobinPolicy, HostDistance,
+                                    TokenAwarePolicy)
+
+    if isinstance(contact_points, string_types):
+        contact_points = contact_points.split(',')
+    if (isinstance(compression, string_types) and
+            compression not in locally_supported_compressions):
+        raise ValueError('%s compression requires the %s package' %
+                         (compression, compression))
+    if connections_per_host and (protocol_version is None or
+                                 protocol_version >= 3):
+        raise ValueError('connections_per_host requires protocol_version '
+                         '1 or 2, later versions multiplex one connection')
+    if protocol_version is not None:
+        kwargs['protocol_version'] = protocol_version
+
+    profile = ExecutionProfile(
+        load_balancing_policy=TokenAwarePolicy(
+            DCAwareRoundRobinPolicy(local_dc=local_dc)),
+        request_timeout=request_timeout)
+    cluster = Cluster(contact_points, port=port, compression=compression,
+                      connect_timeout=connect_timeout,
+                      executor_threads=executor_threads,
+                      execution_profiles={EXEC_PROFILE_DEFAULT: profile},
+                      **kwargs)
+    if connections_per_host:
+        if isinstance(connections_per_host, numbers.Integral):
+            connections_per_host = (connections_per_host,
+                                    connections_per_host)
+        core, maximum = connections_per_host
+        cluster.set_max_connections_per_host(HostDistance.LOCAL, maximum)
+        cluster.set_core_connections_per_host(HostDistance.LOCAL, core)
+    return cluster
 
 
 def create_keyspace(cluster, name,
@@ -29,13 +104,16 @@ def drop_keyspace(cluster, name):
     session.shutdown()
 
 
-def create_table(cluster, keyspace, name, columns, primary_key):
+def create_table(cluster, keyspace, name, columns, primary_key,
+                 options=None):
     """Created a table
        :param cluster: instance of cassandra.Cluster
        :param keyspace: keyspace name
        :param name: name of table
        :param columns: dict of columns names and types
        :param primary_key: list of columns included to promary key
+       :param options: dict of table options, 'clustering_order' may be
+                       'ASC' or 'DESC' for all clustering columns
     """
     session = cluster.connect()
     if keyspace not in cluster.metadata.keyspaces:
@@ -46,5 +124,85 @@ def create_table(cluster, keyspace, name, columns, primary_key):
             """ % (name,
                    ', '.join(['%s %s' % (k, v) for k, v in columns.items()]),
                    ', '.join(primary_key),)
+    options = dict(options or {})
+    clauses = []
+    order = options.pop('clustering_order', None)
+    if order:
+        clauses.append('CLUSTERING ORDER BY (%s)' % ', '.join(
+            '%s %s' % (column, order) for column in primary_key[1:]))
+    clauses.extend(_format_options(options))
+    if clauses:
+        query += ' WITH ' + ' AND '.join(clauses)
     session.execute(query)
     session.shutdown()
+
+
+def alter_table(cluster, keyspace, name, options):
+    """Applies options to an existing table
+       :param cluster: instance of cassandra.Cluster
+       :param keyspace: keyspace name
+       :param name: name of table
+       :param options: dict of table options, nothing is done if empty
+    """
+    if 'clustering_order' in options:
+        raise ValueError("Clustering order of a table can't be altered")
+    if not options:
+        return
+    session = cluster.connect(keyspace)
+    session.execute('ALTER TABLE %s WITH %s' % (
+        name, ' AND '.join(_format_options(options))))
+    session.shutdown()
+
+
+def timeseries_table_options(intervals, counters=False,
+                             compression='LZ4Compressor'):
+    """Table options suited to the retention of a set of intervals:
+       time window compaction with one window per step of the largest
+       interval, so expired data is dropped as whole sstables, and a
+       default TTL when every interval expires.
+       :param intervals: intervals config of a series
+       :param counters: whether the table has counter columns, which
+                        don't support a default TTL
+       :param compression: sstable compression class
+    """
+    steps = [GREGORIAN_STEPS.get(config['step'], config['step'])
+             for config in intervals.values()]
+    window = max(steps)
+    if window % 86400 == 0:
+        unit, size = 'DAYS', window // 86400
+    elif window % 3600 == 0:
+        unit, size = 'HOURS', window // 3600
+    else:
+        unit, size = 'MINUTES', max(1, int(math.ceil(window / 60.0)))
+
+    options = {
+        'compaction': {
+            'class': 'TimeWindowCompactionStrategy',
+            'compaction_window_unit': unit,
+            'compaction_window_size': size,
+        },
+    }
+    if compression:
+        options['compression'] = {'class': compression}
+
+    ttls = [config.get('expire') for config in intervals.values()]
+    if not counters and ttls and all(ttls):
+        options['default_time_to_live'] = max(ttls)
+    return options
+
+
+def _format_options(options):
+    return ['%s = %s' % (k, _format_option_value(v))
+            for k, v in sorted(options.items())]
+
+
+def _format_option_value(value):
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(
+            "'%s': %s" % (k, _format_option_value(v))
+            for k, v in sorted(value.items()))
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, numbers.Number):
+        return str(value)
+    return "'%s'" % value
@@ -29,10 +29,17 @@ setup(
     extras_require={
         'tests': unittest2_requires,
         'dev': dev_requires,
+        'lz4': ['lz4'],
     },
     license='BSD',
     tests_require=unittest2_requires,
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'kairos-cassandra-export = kairos_cassandra_driver.export:main',
+            'kairos-cassandra-load = kairos_cassandra_driver.loader:main',
+        ],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
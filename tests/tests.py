@@ -1,15 +1,39 @@
 
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import time
 import unittest
 from collections import OrderedDict
 
+import kairos
+from cassandra import InvalidRequest
 from cassandra.cluster import Cluster
+from cassandra.policies import (
+    ConstantSpeculativeExecutionPolicy,
+    RetryPolicy,
+)
 
 from kairos_cassandra_driver import (
     Timeseries,
     CassandraSeries,
+    Recorder,
+    ShardedTimeseries,
+)
+from kairos_cassandra_driver.cassandra_timeseries import (
+    CassandraHistogramSketch,
+    CassandraSetSketch,
 )
+from kairos_cassandra_driver.export import export, SeriesFile
+from kairos_cassandra_driver.helpers import calculate_irtime
+from kairos_cassandra_driver.leaderboard import Leaderboard
+from kairos_cassandra_driver.loader import load, read_records
+from kairos_cassandra_driver.sketches import HyperLogLog, SpaceSaving
+from kairos_cassandra_driver.spool import Spool, SpoolReplayer
 from kairos_cassandra_driver.utils import (
+    create_cluster,
     create_keyspace,
     drop_keyspace,
 )
@@ -535,3 +559,770 @@ class TestCassandraSeries(TestCassandraTimeseries):
         self.assertEqual(map(self._time, [0]), interval.keys())
         self.assertEqual({'min': 1, 'max': 3839, 'count': 718},
                          interval[self._time(0)])
+
+    def test_series_multi(self):
+        for t in xrange(1, 300):
+            self.series.insert('test', t, timestamp=self._time(t))
+
+        rval = self.series.series_multi('test', ['minute', 'hour'],
+                                        end=self._time(250))
+        self.assertEqual(['hour', 'minute'], sorted(rval))
+        for interval in ('minute', 'hour'):
+            self.assertEqual(
+                self.series.series('test', interval, end=self._time(250)),
+                rval[interval])
+
+    def test_aggregate(self):
+        for t in xrange(0, 300, 30):
+            for host in xrange(3):
+                self.series.insert('api.%d.requests' % host, host,
+                                   timestamp=self._time(t))
+        self.series.insert('db.requests', 100, timestamp=self._time(0))
+
+        rval = self.series.aggregate('api.*.requests', 'minute',
+                                     end=self._time(299), concurrency=2)
+        self.assertEqual([[0, 0, 1, 1, 2, 2]] * 5,
+                         [sorted(v) for v in rval.values()])
+        rval = self.series.aggregate(['api.0.requests', 'db.requests'],
+                                     'minute', end=self._time(299),
+                                     transform='sum')
+        self.assertEqual([100, 0, 0, 0, 0], rval.values())
+
+    def test_delete_range(self):
+        for t in xrange(0, 300, 30):
+            self.series.insert('test', t, timestamp=self._time(t))
+
+        self.series.delete_range('test', 'minute', self._time(150))
+        interval = self.series.series('test', 'minute', end=self._time(299))
+        self.assertEqual([[], [], [120, 150], [180, 210], [240, 270]],
+                         interval.values())
+        self.assertEqual(range(0, 300, 30), self.series.series(
+            'test', 'hour', end=self._time(299), condensed=True).values()[0])
+
+    def test_purge(self):
+        for t in xrange(0, 300, 30):
+            self.series.insert('test1', t, timestamp=self._time(t))
+            self.series.insert('test2', t, timestamp=self._time(t))
+        self.assertEqual(['test1', 'test2'], sorted(self.series.list()))
+
+        progress = []
+        deleted = self.series.purge({'minute': 100}, now=self._time(299),
+                                    rate=100,
+                                    progress=lambda *args: progress.append(args))
+        self.assertEqual(2, deleted)
+        self.assertEqual((2, 2), progress[-1])
+        for name in ('test1', 'test2'):
+            interval = self.series.series(name, 'minute', end=self._time(299))
+            self.assertEqual([[], [], [], [180, 210], [240, 270]],
+                             interval.values())
+
+    def test_bucket_calculator(self):
+        config = self.series._intervals['hour']
+        calc = config['bucket_calc']
+        now = time.time()
+        timestamps = [now - t * 7.5 for t in xrange(1000)]
+        expected = [calculate_irtime(config, t) + (config['ttl'](t),)
+                    for t in timestamps]
+        self.assertEqual(expected, map(calc.buckets, timestamps))
+
+        calc.prime(timestamps)
+        self.assertEqual(expected, map(calc.buckets, timestamps))
+        calc.clear()
+
+
+class TestCassandraSetSketch(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestCassandraSetSketch, self).setUp()
+        self.series = Timeseries(self.cluster,
+                                 type='set',
+                                 sketch=True,
+                                 intervals=self.intervals,
+                                 keyspace=TEST_KEYSPACE)
+
+    def test_backends_choise(self):
+        self.assertTrue(isinstance(self.series, CassandraSetSketch))
+
+    def test_sketch_roundtrip(self):
+        sketch = HyperLogLog(10)
+        for v in xrange(1000):
+            sketch.add(v)
+        self.assertEqual(sketch, HyperLogLog.from_bytes(sketch.to_bytes()))
+        self.assertAlmostEqual(1000, len(sketch), delta=50)
+
+    def test_get_cardinality(self):
+        for t in xrange(1, 120):
+            self.series.insert('test', t % 50, timestamp=self._time(t))
+
+        interval = self.series.get('test', 'minute',
+                                   timestamp=self._time(100),
+                                   transform='count')
+        self.assertEqual(50, interval[self._time(60)])
+
+        # a second writer merges into the same buckets on read
+        other = Timeseries(self.cluster, type='set', sketch=True,
+                           intervals=self.intervals,
+                           keyspace=TEST_KEYSPACE)
+        for t in xrange(60, 120):
+            other.insert('test', 1000 + t, timestamp=self._time(t))
+        interval = self.series.get('test', 'minute',
+                                   timestamp=self._time(100))
+        self.assertAlmostEqual(110, len(interval[self._time(60)]), delta=5)
+
+    def test_delete(self):
+        self.series.insert('test', 1, timestamp=self._time(0))
+        self.series.delete('test')
+        self.series.insert('test', 1, timestamp=self._time(0))
+        interval = self.series.get('test', 'minute', timestamp=self._time(0),
+                                   transform='count')
+        self.assertEqual(1, interval[self._time(0)])
+
+
+class TestCassandraHistogramSketch(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestCassandraHistogramSketch, self).setUp()
+        # counter updates can't have a TTL, so no interval expires
+        self.series = Timeseries(self.cluster,
+                                 type='histogram',
+                                 sketch=True,
+                                 sketch_accuracy=0.01,
+                                 intervals={'minute': {'step': 60}},
+                                 keyspace=TEST_KEYSPACE)
+
+    def test_backends_choise(self):
+        self.assertTrue(isinstance(self.series, CassandraHistogramSketch))
+
+    def test_percentiles(self):
+        # 1000 distinct latencies fold into far fewer bins
+        for t in xrange(1000):
+            self.series.insert('test', 1 + t * 0.1, timestamp=self._time(0))
+
+        interval = self.series.get('test', 'minute', timestamp=self._time(0))
+        self.assertTrue(len(interval[self._time(0)]) < 400)
+        self.assertEqual(1000, sum(interval[self._time(0)].values()))
+
+        interval = self.series.get('test', 'minute',
+                                   timestamp=self._time(0),
+                                   transform=['p50', 'p99'])
+        self.assertAlmostEqual(50.9, interval[self._time(0)]['p50'], delta=1)
+        self.assertAlmostEqual(99.9, interval[self._time(0)]['p99'], delta=1.5)
+
+
+class TestCassandraGauge(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestCassandraGauge, self).setUp()
+        self.series = Timeseries(self.cluster,
+                                 type='gauge',
+                                 dedupe_cache_size=100,
+                                 intervals=self.intervals,
+                                 keyspace=TEST_KEYSPACE)
+
+    def test_dedupe(self):
+        for t in xrange(0, 60, 5):
+            self.series.insert('test', 3, timestamp=self._time(t))
+        self.series.insert('test', 4, timestamp=self._time(59))
+
+        # 2 intervals, each written once for 3 and once for 4
+        self.assertEqual(22, self.series.stats['suppressed_writes'])
+        interval = self.series.get('test', 'minute', timestamp=self._time(0))
+        self.assertEqual(4, interval[self._time(0)])
+
+    def test_dedupe_after_delete(self):
+        self.series.insert('test', 3, timestamp=self._time(0))
+        self.series.delete('test')
+        self.series.insert('test', 3, timestamp=self._time(0))
+        self.assertEqual(0, self.series.stats['suppressed_writes'])
+        interval = self.series.get('test', 'minute', timestamp=self._time(0))
+        self.assertEqual(3, interval[self._time(0)])
+
+    def test_speculative_execution(self):
+        retry_policy = RetryPolicy()
+        speculative_policy = ConstantSpeculativeExecutionPolicy(0.05, 2)
+        gauge = Timeseries(self.cluster,
+                           type='gauge',
+                           intervals=self.intervals,
+                           keyspace=TEST_KEYSPACE,
+                           retry_policy=retry_policy,
+                           speculative_execution_policy=speculative_policy)
+        stmt = gauge._type_get_stmt('test', 'minute', 1)
+        self.assertTrue(stmt.is_idempotent)
+        self.assertIs(retry_policy, stmt.retry_policy)
+
+        gauge.insert('test', 5, timestamp=self._time(0))
+        self.assertEqual(
+            5, gauge.get('test', 'minute', timestamp=self._time(0)).values()[0])
+
+        # The profile of the policy is registered once per cluster
+        profiles = len(self.cluster.profile_manager.profiles)
+        other = Timeseries(self.cluster,
+                           type='gauge',
+                           intervals=self.intervals,
+                           keyspace=TEST_KEYSPACE,
+                           speculative_execution_policy=speculative_policy)
+        other.insert('test', 6, timestamp=self._time(0))
+        self.assertEqual(gauge._speculative_profile,
+                         other._speculative_profile)
+        self.assertEqual(profiles, len(self.cluster.profile_manager.profiles))
+
+
+class TestCassandraSet(TestCassandraTimeseries):
+
+    def _series(self, **kwargs):
+        return Timeseries(self.cluster,
+                          type='set',
+                          intervals=self.intervals,
+                          keyspace=TEST_KEYSPACE,
+                          **kwargs)
+
+    def test_membership_filter(self):
+        for membership_filter in ('lru', 'bloom'):
+            series = self._series(membership_filter=membership_filter,
+                                  membership_filter_size=1000)
+            series.delete('test')
+            for t in xrange(120):
+                series.insert('test', t % 10, timestamp=self._time(t))
+
+            # 10 members in 2 minute buckets for both intervals
+            self.assertEqual(200, series.stats['suppressed_writes'])
+            interval = series.get('test', 'minute', timestamp=self._time(60))
+            self.assertEqual(set(range(10)), interval[self._time(60)])
+
+            series.delete('test')
+            series.insert('test', 1, timestamp=self._time(60))
+            interval = series.get('test', 'minute', timestamp=self._time(60))
+            self.assertEqual(set([1]), interval[self._time(60)])
+
+    def test_bloom_filter_capacity(self):
+        series = self._series(membership_filter='bloom',
+                              membership_filter_size=100,
+                              membership_filter_error=1e-6)
+        for value in xrange(1000):
+            series.insert('test', value, timestamp=self._time(0))
+        self.assertEqual(18, series.stats['membership_filter_resets'])
+        interval = series.get('test', 'minute', timestamp=self._time(0))
+        self.assertEqual(set(range(1000)), interval[self._time(0)])
+
+
+class TestTableOptions(TestCassandraTimeseries):
+
+    def test_time_window_compaction(self):
+        series = Timeseries(self.cluster,
+                            type='gauge',
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE,
+                            time_window_compaction=True,
+                            table_options={'clustering_order': 'DESC'})
+        # The table is created with the first session
+        series._get_session()
+        self.cluster.refresh_table_metadata(TEST_KEYSPACE, 'gauge')
+        table = self.cluster.metadata.keyspaces[TEST_KEYSPACE].tables['gauge']
+        compaction = table.options['compaction']
+        self.assertTrue(compaction['class'].endswith('TimeWindowCompactionStrategy'))
+        self.assertEqual('HOURS', compaction['compaction_window_unit'])
+        self.assertEqual('1', compaction['compaction_window_size'])
+        # the hour interval does not expire
+        self.assertEqual(0, table.options['default_time_to_live'])
+        self.assertTrue(table.clustering_key[1].is_reversed)
+
+
+class TestCreateCluster(TestCassandraTimeseries):
+
+    def test_contact_points(self):
+        series = Timeseries(['127.0.0.1'],
+                            type='gauge',
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE,
+                            request_timeout=5,
+                            executor_threads=4)
+        self.assertEqual(
+            5, series.cluster.profile_manager.default.request_timeout)
+        series.insert('test', 3, timestamp=self._time(0))
+        self.assertEqual(
+            3, series.get('test', 'minute', timestamp=self._time(0)).values()[0])
+        series.close()
+        self.assertTrue(series.cluster.is_shutdown)
+
+        series = Timeseries('127.0.0.1',
+                            type='gauge',
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE)
+        self.assertEqual(
+            3, series.get('test', 'minute', timestamp=self._time(0)).values()[0])
+        series.close()
+        self.assertTrue(series.cluster.is_shutdown)
+
+    def test_kairos_factory(self):
+        # kairos initialises the series returned by its backend
+        backend = kairos.timeseries.BACKENDS['cassandra']
+        self.assertEqual(None, backend('127.0.0.1', type='gauge',
+                                       intervals=self.intervals).cluster)
+        series = kairos.Timeseries('127.0.0.1',
+                                   type='gauge',
+                                   intervals=self.intervals,
+                                   keyspace=TEST_KEYSPACE)
+        series.insert('test', 3, timestamp=self._time(0))
+        self.assertEqual(
+            3, series.get('test', 'minute', timestamp=self._time(0)).values()[0])
+        series.close()
+        self.assertTrue(series.cluster.is_shutdown)
+
+    def test_connections_per_host(self):
+        self.assertRaises(ValueError, create_cluster, ['127.0.0.1'],
+                          connections_per_host=4)
+
+
+class TestSpool(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestSpool, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(TestSpool, self).tearDown()
+
+    def test_segments(self):
+        spool = Spool(self.path, segment_size=100)
+        for i in xrange(10):
+            spool.append('UPDATE %d' % i, 1, True)
+        self.assertTrue(len(spool.segments()) > 1)
+        queries = [record[2] for segment in spool.segments()
+                   for record in spool.read(segment)]
+        self.assertEqual(['UPDATE %d' % i for i in xrange(10)], queries)
+
+    def test_replay(self):
+        series = Timeseries(self.cluster,
+                            type='series',
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE,
+                            spool=self.path,
+                            spool_mode='always')
+        for t in xrange(10):
+            series.insert('test', t, timestamp=self._time(t))
+
+        self.assertEqual(20, series.stats['spooled_writes'])
+        self.assertTrue(series.spool_lag()['bytes'] > 0)
+        interval = series.get('test', 'minute', timestamp=self._time(0))
+        self.assertEqual([], interval[self._time(0)])
+
+        self.assertEqual(20, series.replay_spool(batch_size=3))
+        self.assertEqual(0, series.spool_lag()['bytes'])
+        interval = series.get('test', 'minute', timestamp=self._time(0))
+        self.assertEqual(list(range(10)), interval[self._time(0)])
+
+    def test_replay_error(self):
+        series = Timeseries(self.cluster,
+                            type='gauge',
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE)
+        spool = Spool(self.path)
+        spool.append("INSERT INTO gauge (name, interval, i_time, r_time, "
+                     "value) VALUES ('test', 'minute', 0, -1, 1)", key='a')
+        spool.append("INSERT INTO missing (name) VALUES ('test')", key='b')
+        replayer = SpoolReplayer(spool, series._get_session())
+        self.assertEqual(1, replayer.replay())
+        self.assertTrue(isinstance(replayer.last_error, InvalidRequest))
+        series.close()
+
+    def test_replay_set_sketch(self):
+        series = Timeseries(self.cluster,
+                            type='set',
+                            sketch=True,
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE,
+                            spool=self.path,
+                            spool_mode='always')
+        for member in 'abc':
+            series.insert('test', member, timestamp=self._time(0))
+
+        self.assertEqual(6, series.replay_spool())
+        interval = series.get('test', 'minute', timestamp=self._time(0),
+                              transform='count')
+        self.assertEqual(3, interval[self._time(0)])
+
+
+class TestExport(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.series = Timeseries(self.cluster,
+                                 type='series',
+                                 intervals=self.intervals,
+                                 keyspace=TEST_KEYSPACE)
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(TestExport, self).tearDown()
+
+    def test_export(self):
+        for t in xrange(1, 300):
+            self.series.insert('test1', t, timestamp=self._time(t))
+            self.series.insert('test2', -t, timestamp=self._time(t))
+
+        count = export(self.series, self.path, fetch_size=50)
+        self.assertEqual(4 * 299, count)
+
+        f = SeriesFile(self.path)
+        self.assertEqual(['test1', 'test2'], f.names())
+        self.assertEqual(self.series.get('test1', 'minute', timestamp=self._time(100)),
+                         f.get('test1', 'minute', self._time(100)))
+        self.assertEqual(self.series.get('test2', 'hour', timestamp=self._time(100)),
+                         f.get('test2', 'hour', self._time(100)))
+        interval = f.series('test1', 'minute', self._time(60), self._time(130))
+        self.assertEqual(map(self._time, [60, 120]), interval.keys())
+        self.assertEqual(list(range(120, 180)), interval[self._time(120)])
+        f.close()
+
+    def test_export_sketch(self):
+        series = Timeseries(self.cluster,
+                            type='histogram',
+                            sketch=True,
+                            intervals={'minute': {'step': 60}},
+                            keyspace=TEST_KEYSPACE)
+        for _ in xrange(3):
+            series.insert('test', 0.25, timestamp=self._time(0))
+        self.assertEqual(1, export(series, self.path))
+        f = SeriesFile(self.path)
+        self.assertEqual(series.get('test', 'minute', timestamp=self._time(0)),
+                         f.get('test', 'minute', self._time(0)))
+        f.close()
+
+        series = Timeseries(self.cluster,
+                            type='set',
+                            sketch=True,
+                            intervals=self.intervals,
+                            keyspace=TEST_KEYSPACE)
+        self.assertRaises(TypeError, export, series, self.path)
+        self.assertEqual(None, series.session)
+
+
+class TestLoader(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestLoader, self).setUp()
+        self.kwargs = {'type': 'count',
+                       'intervals': {'minute': {'step': 60}},
+                       'keyspace': TEST_KEYSPACE}
+        self.series = Timeseries(self.cluster, **self.kwargs)
+        # The table is created on first use, and the loader doesn't
+        self.series._get_session()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'dump.csv')
+        with open(self.path, 'w') as f:
+            f.write('timestamp,name,value\n')
+            for t in xrange(1, 300):
+                f.write('%s,test%d,%d\n' % (self._time(t), t % 3, t))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestLoader, self).tearDown()
+
+    def test_load(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        count = load(self.path, ['127.0.0.1'], self.kwargs, workers=2,
+                     chunk_size=50, checkpoint=checkpoint, progress=None)
+        self.assertEqual(299, count)
+        self.assertEqual(
+            sum(t for t in xrange(60, 120) if t % 3 == 1),
+            self.series.get('test1', 'minute',
+                            timestamp=self._time(60)).values()[0])
+
+        # Everything is checkpointed, loading again writes nothing
+        count = load(self.path, ['127.0.0.1'], self.kwargs, workers=2,
+                     chunk_size=50, checkpoint=checkpoint, progress=None)
+        self.assertEqual(0, count)
+
+    def test_value_type(self):
+        path = os.path.join(self.tmpdir, 'users.csv')
+        with open(path, 'w') as f:
+            f.write('%s,users,12345\n%s,users,1.5\n' % (
+                self._time(0), self._time(1)))
+        self.assertEqual(['12345', '1.5'], [
+            record[3] for record in read_records(path, value_type='text')])
+        self.assertEqual([12345, 1.5], [
+            record[3] for record in read_records(path, value_type=float)])
+
+
+class TestSeriesCursor(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestSeriesCursor, self).setUp()
+        self.series = Timeseries(self.cluster,
+                                 type='series',
+                                 intervals=self.intervals,
+                                 keyspace=TEST_KEYSPACE)
+
+    def test_poll(self):
+        for t in xrange(1, 300):
+            self.series.insert('test', t, timestamp=self._time(t))
+
+        cursor = self.series.cursor('test', 'minute', end=self._time(299))
+        self.assertEqual(self.series.series('test', 'minute', end=self._time(299)),
+                         cursor.result)
+        self.assertEqual({}, cursor.poll())
+
+        self.series.insert('test', 1000, timestamp=self._time(299))
+        self.series.insert('test', 1001, timestamp=self._time(300))
+        delta = cursor.poll(end=self._time(300))
+        self.assertEqual([self._time(240), self._time(300)], delta.keys())
+        self.assertEqual(range(240, 300) + [1000], delta[self._time(240)])
+        self.assertEqual([1001], delta[self._time(300)])
+        self.assertEqual(self.series.series('test', 'minute', end=self._time(300)),
+                         cursor.result)
+
+
+class TestTracing(TestCassandraTimeseries):
+
+    def setUp(self):
+        super(TestTracing, self).setUp()
+        self.series = Timeseries(self.cluster,
+                                 type='series',
+                                 intervals=self.intervals,
+                                 keyspace=TEST_KEYSPACE,
+                                 trace_sample_rate=1,
+                                 trace_history=5,
+                                 hot_names_size=10)
+
+    def test_hot_names(self):
+        for t in xrange(30):
+            self.series.insert('hot', t, timestamp=self._time(t))
+            if t % 10 == 0:
+                self.series.insert('cold', t, timestamp=self._time(t))
+        self.series.series('cold', 'minute', end=self._time(60))
+
+        hot = self.series.hot_names(2)
+        self.assertEqual(['hot', 'cold'], [h['name'] for h in hot])
+        # one write per interval, and one read
+        self.assertEqual(60, hot[0]['requests'])
+        self.assertEqual(7, hot[1]['requests'])
+        self.assertEqual('cold', self.series.hot_names(1, by='rows')[0]['name'])
+
+        traces = self.series.traces(max_wait=5)
+        self.assertEqual(5, len(traces))
+        self.assertTrue(all(t['coordinator'] for t in traces))
+
+    def test_hot_names_paging(self):
+        for t in xrange(30):
+            self.series.insert('test', t, timestamp=self._time(t * 60))
+        stmt = self.series._type_get_stmt('test', 'hour', -2 ** 63,
+                                          2 ** 63 - 1)
+        stmt.fetch_size = 2
+        result = self.series._execute(stmt, name='test')
+        self.assertFalse(isinstance(result, list))
+        self.assertEqual([], self.series.hot_names(1, by='rows'))
+        self.assertEqual(30, len(list(result)))
+        self.assertEqual(30, self.series.hot_names(1, by='rows')[0]['rows'])
+
+    def test_space_saving(self):
+        sketch = SpaceSaving(5)
+        for i in xrange(1000):
+            sketch.add('heavy' if i % 4 == 0 else i)
+        key, count, error = sketch.top(1)[0]
+        self.assertEqual('heavy', key)
+        self.assertTrue(count - error <= 250 <= count)
+
+
+class TestRecorder(TestCassandraTimeseries):
+
+    def test_record(self):
+        def series(ttype, **kwargs):
+            kwargs.setdefault('intervals', self.intervals)
+            return Timeseries(self.cluster, type=ttype,
+                              keyspace=TEST_KEYSPACE, **kwargs)
+        # counter updates can't have a TTL, so no interval expires
+        minute = {'minute': {'step': 60}}
+        events = series('count', intervals=minute)
+        latency = series('histogram', intervals=minute)
+        users = series('set', value_type=str)
+        recorder = Recorder({'events': events, 'latency': latency,
+                             'users': users})
+        try:
+            recorder.record('checkout', {'events': 1, 'latency': 0.25,
+                                         'users': 'u1'},
+                            timestamp=self._time(0))
+            recorder.record('checkout', {'events': 1, 'latency': 0.5,
+                                         'users': ['u1', 'u2']},
+                            timestamp=self._time(1))
+            recorder.record('checkout', {'events': 1},
+                            timestamp=self._time(2))
+        finally:
+            recorder.close()
+
+        timestamp = self._time(0)
+        self.assertEqual(3, events.get(
+            'checkout', 'minute', timestamp=timestamp).values()[0])
+        self.assertEqual({0.25: 1, 0.5: 1}, latency.get(
+            'checkout', 'minute', timestamp=timestamp).values()[0])
+        self.assertEqual(set(['u1', 'u2']), users.get(
+            'checkout', 'minute', timestamp=timestamp).values()[0])
+        self.assertRaises(ValueError, recorder.record, 'checkout',
+                          {'unknown': 1})
+
+    def test_record_order(self):
+        timeline = Timeseries(self.cluster, type='series',
+                              intervals=self.intervals,
+                              keyspace=TEST_KEYSPACE)
+        level = Timeseries(self.cluster, type='gauge',
+                           intervals=self.intervals,
+                           keyspace=TEST_KEYSPACE)
+        recorder = Recorder({'timeline': timeline, 'level': level})
+        try:
+            recorder.record('checkout', {'timeline': range(20),
+                                         'level': [5, 3, 1, 2]},
+                            timestamp=self._time(0))
+        finally:
+            recorder.close()
+
+        self.assertEqual(range(20), timeline.get(
+            'checkout', 'minute', timestamp=self._time(0)).values()[0])
+        self.assertEqual(2, level.get(
+            'checkout', 'minute', timestamp=self._time(0)).values()[0])
+
+
+class TestLeaderboard(TestCassandraTimeseries):
+
+    def test_top(self):
+        # Counter updates can't expire
+        minute = {'minute': {'step': 60}}
+
+        def series(**kwargs):
+            return Timeseries(self.cluster, type='count',
+                              intervals=minute,
+                              keyspace=TEST_KEYSPACE,
+                              leaderboard_size=5, **kwargs)
+        writer1 = series(leaderboard_flush_interval=0)
+        writer2 = series()
+        for t in xrange(60):
+            writer1.insert('endpoint%d' % (t % 10), timestamp=self._time(t))
+            writer2.insert('busy', 3, timestamp=self._time(t))
+        writer2.insert('busy', timestamp=self._time(60))
+        writer2.close()
+
+        top = writer1.top('minute', self._time(0), 2)
+        self.assertEqual(('busy', 180, 0), top[0])
+        self.assertEqual(2, len(top))
+        self.assertEqual([('busy', 1, 0)], writer1.top('minute', self._time(60)))
+        self.assertRaises(ValueError, Timeseries(
+            self.cluster, type='count', intervals=minute,
+            keyspace=TEST_KEYSPACE).top, 'minute')
+
+    def test_failed_flush(self):
+        leaderboard = Leaderboard(5, flush_interval=0)
+        leaderboard.add('minute', 0, None, 'a', 2)
+        leaderboard.add('minute', 60, None, 'b')
+        self.assertTrue(leaderboard.due())
+        changes = leaderboard.changes()
+        self.assertEqual([(0, [('a', 2, 0)]), (60, [('b', 1, 0)])],
+                         [(c[1], c[3]) for c in changes])
+
+        # Rows not applied, such as after a failed write, come back
+        changes[1][5]()
+        changes = leaderboard.changes()
+        self.assertEqual([(0, [('a', 2, 0)])],
+                         [(c[1], c[3]) for c in changes])
+        changes[0][5]()
+        self.assertEqual([], leaderboard.changes())
+
+
+class TestSharding(TestCassandraTimeseries):
+
+    keyspaces = [TEST_KEYSPACE + '_shard%d' % i for i in xrange(3)]
+
+    def tearDown(self):
+        for keyspace in self.keyspaces:
+            drop_keyspace(self.cluster, keyspace)
+        super(TestSharding, self).tearDown()
+
+    def test_add_shard(self):
+        series = ShardedTimeseries({'a': (self.cluster, self.keyspaces[0]),
+                                    'b': (self.cluster, self.keyspaces[1])},
+                                   type='count',
+                                   intervals={'minute': {'step': 60}})
+        names = ['api.%d' % i for i in xrange(20)]
+        for i, name in enumerate(names):
+            series.insert(name, i, timestamp=self._time(0))
+        self.assertEqual(sorted(names), series.list())
+        self.assertEqual(2, len(set(series.shard(name) for name in names)))
+
+        def total():
+            return series.aggregate('api.*', 'minute', start=self._time(0),
+                                    end=self._time(0)).values()[0]
+        self.assertEqual(sum(xrange(20)), total())
+
+        moved = []
+        series.add_shard('c', self.cluster, self.keyspaces[2],
+                         progress=moved.append).join()
+        self.assertEqual(None, series.rebalance_error)
+        self.assertTrue(moved)
+        self.assertEqual(set(['c']), set(series.shard(name) for name in moved))
+        self.assertEqual(sorted(names), series.list())
+        self.assertEqual(sum(xrange(20)), total())
+        for i, name in enumerate(names):
+            self.assertEqual(i, series.get(name, 'minute',
+                                           timestamp=self._time(0)).values()[0])
+        series.close()
+
+    def test_resume_rebalance(self):
+        series = ShardedTimeseries({'a': (self.cluster, self.keyspaces[0])},
+                                   type='count',
+                                   intervals={'minute': {'step': 60}})
+        names = ['api.%d' % i for i in xrange(20)]
+        for i, name in enumerate(names):
+            series.insert(name, i + 1, timestamp=self._time(0))
+
+        def fail(name):
+            raise ValueError(name)
+        series.add_shard('b', self.cluster, self.keyspaces[1],
+                         progress=fail).join()
+        self.assertTrue(isinstance(series.rebalance_error, ValueError))
+        self.assertRaises(ValueError, series.add_shard, 'c', self.cluster,
+                          self.keyspaces[2])
+        self.assertEqual(sorted(names), series.list())
+
+        moved = [series.rebalance_error.args[0]]
+        series.resume_rebalance(progress=moved.append).join()
+        self.assertEqual(None, series.rebalance_error)
+        self.assertRaises(ValueError, series.resume_rebalance)
+        self.assertEqual(set(['b']), set(series.shard(name) for name in moved))
+        self.assertEqual(sorted(names), series.list())
+        for i, name in enumerate(names):
+            self.assertEqual(i + 1, series.get(name, 'minute',
+                                           timestamp=self._time(0)).values()[0])
+        series.close()
+
+
+class TestStartup(TestCassandraTimeseries):
+
+    def test_lazy_import(self):
+        code = ('import sys, kairos_cassandra_driver.loader; '
+                'print(sorted(m for m in ("kairos", "cassandra") '
+                'if m in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual('[]', output.strip())
+
+        # With kairos imported first, the backend is registered in kairos
+        # before being imported
+        code = ('import kairos, kairos_cassandra_driver; '
+                'from cassandra.cluster import Cluster; '
+                'print(type(kairos.Timeseries(Cluster(), type="count", '
+                'intervals={"minute": {"step": 60}})).__name__)')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual('CassandraCount', output.strip())
+
+    def test_deferred_table(self):
+        series = Timeseries(self.cluster,
+                            type='count',
+                            intervals={'minute': {'step': 60}},
+                            keyspace=TEST_KEYSPACE,
+                            table_name='deferred')
+        self.assertEqual(None, series.session)
+        self.cluster.refresh_keyspace_metadata(TEST_KEYSPACE)
+        tables = self.cluster.metadata.keyspaces[TEST_KEYSPACE].tables
+        self.assertFalse('deferred' in tables)
+
+        series.insert('test', timestamp=self._time(0))
+        self.assertEqual(1, series.get('test', 'minute',
+                                       timestamp=self._time(0)).values()[0])